@@ -33,14 +33,35 @@ net_arg.add_argument('--sparsity', type=float, default=0.01)
 net_arg.add_argument('--w4', type=float, default=1.0, help='weight for p')
 net_arg.add_argument('--w5', type=float, default=1.0, help='weight for sparsity constraint')
 net_arg.add_argument('--w_size', type=int, default=5)
+net_arg.add_argument('--recompute', type=str, default='none', choices=['none', 'conv'],
+                     help='recompute 3d conv activations in backprop, keeping the input of each conv')
 
 # Data
 data_arg = add_argument_group('Data')
-data_arg.add_argument('--dataset', type=str, default='smoke_pos21_size5_f200')
+data_arg.add_argument('--dataset', type=str, default='smoke_pos21_size5_f200',
+                      help='comma-separated datasets are mixed into one input pipeline')
+data_arg.add_argument('--dataset_weights', type=str, default='',
+                      help='comma-separated sampling weights of the datasets, default: by size')
 data_arg.add_argument('--batch_size', type=int, default=8)
 data_arg.add_argument('--test_batch_size', type=int, default=100)
 data_arg.add_argument('--num_worker', type=int, default=2)
+data_arg.add_argument('--prefetch_mb', type=int, default=0,
+                      help='memory budget of prefetched samples, 0: fixed queue sizes')
+data_arg.add_argument('--cache_mb', type=int, default=0,
+                      help='LRU cache of decoded samples (per decoding process), 0: no cache')
+data_arg.add_argument('--num_proc', type=int, default=0,
+                      help='processes decoding samples for the enqueue threads, 0: decode in threads')
 data_arg.add_argument('--data_type', type=str, default='velocity')
+data_arg.add_argument('--input_pipeline', type=str, default='queue', choices=['queue', 'dataset'],
+                      help='FIFOQueue fed by enqueue threads or a tf.data pipeline')
+data_arg.add_argument('--data_format', type=str, default='npz', choices=['npz', 'packed'],
+                      help='per-sample npz files or a packed memmap (see data_tool.py)')
+data_arg.add_argument('--precomputed_jaco', type=str2bool, default=False,
+                      help='feed the jacobians packed with data_tool.py --jaco instead of computing them per step')
+data_arg.add_argument('--crop_x', type=int, default=0,
+                      help='train 3d generators on random sub-volumes of this size, 0: full domain')
+data_arg.add_argument('--crop_y', type=int, default=0)
+data_arg.add_argument('--crop_z', type=int, default=0)
 
 # Training / test parameters
 train_arg = add_argument_group('Training')
@@ -55,6 +76,19 @@ train_arg.add_argument('--beta1', type=float, default=0.5)
 train_arg.add_argument('--beta2', type=float, default=0.999)
 train_arg.add_argument('--lr_update', type=str, default='decay',
                        choices=['decay', 'step'])
+train_arg.add_argument('--staging', type=str2bool, default=False,
+                       help='copy the next batch to the device while a step runs')
+train_arg.add_argument('--steps_per_call', type=int, default=1,
+                       help='optimizer steps run in-graph per session call')
+train_arg.add_argument('--num_replicas', type=int, default=1,
+                       help='data-parallel training processes, gradients are averaged in shared memory')
+train_arg.add_argument('--accum_steps', type=int, default=1,
+                       help='batches whose mean gradient makes one optimizer step (effective batch size)')
+train_arg.add_argument('--precision', type=str, default='float32', choices=['float32', 'mixed'],
+                       help='mixed: conv stacks in --half_dtype, float32 variables, output layers and losses')
+train_arg.add_argument('--half_dtype', type=str, default='float16', choices=['float16', 'bfloat16'])
+train_arg.add_argument('--loss_scale', type=float, default=0,
+                       help='static loss scale of float16 training, 0: dynamic')
 
 # Misc
 misc_arg = add_argument_group('Misc')
@@ -1,17 +1,26 @@
 import os
 from glob import glob
+from collections import OrderedDict
 
 import threading
 import multiprocessing
+from multiprocessing.pool import ThreadPool
+import queue
 import signal
 import sys
+import time
 from datetime import datetime
 
 import tensorflow as tf
 import numpy as np
 import matplotlib.pyplot as plt
 
-from ops import *
+from ops import jacobian, jacobian3, vort_np, vort_from_jaco_np, plane_view_np, jacobian_np3
+from util import get_rss_mb
+from data_tool import read_args, read_range, read_index, packed_files, jaco_file, normalize_x, manifest_file, manifest_is_current, read_manifest, current_label
+from scene.codec import decode
+from scene.chunks import SceneChunks, has_chunks
+from sampler import EpochSampler, MixedSampler
 
 class BatchManager(object):
     def __init__(self, config):
@@ -19,35 +28,50 @@ class BatchManager(object):
         self.root = config.data_path
 
         # read data generation arguments
-        self.args = {}
-        with open(os.path.join(self.root, 'args.txt'), 'r') as f:
-            while True:
-                line = f.readline()
-                if not line:
-                    break
-                arg, arg_value = line[:-1].split(': ')
-                self.args[arg] = arg_value
+        self.args = read_args(self.root)
 
         self.is_3d = config.is_3d
-        if 'ae' in config.arch:
-            def sortf(x):
-                nf = int(self.args['num_frames'])
-                n = os.path.basename(x)[:-4].split('_')
-                return int(n[0])*nf + int(n[1])
-
-            self.paths = sorted(glob("{}/{}/*".format(self.root, config.data_type[0])),
-                                key=sortf)
-            # num_path = len(self.paths)
-            # num_train = int(num_path*0.95)
-            # self.test_paths = self.paths[num_train:]
-            # self.paths = self.paths[:num_train]
+        self.data_format = config.data_format
+        self.paths, self.manifest = list_paths(self.root, self.args, config)
+
+        # more datasets to mix in, normalized together (see x_range below)
+        self.sources = [(self.root, self.args, self.paths)]
+        for root in config.data_paths[1:]:
+            args = read_args(root)
+            if args['num_param'] != self.args['num_param'] or \
+                args.get('num_dof') != self.args.get('num_dof'):
+                raise Exception("[!] Labels of %s don't match %s" % (root, self.root))
+            self.sources.append((root, args, list_paths(root, args, config)[0]))
+        self.source_sizes = [len(paths) for _, _, paths in self.sources]
+        if config.dataset_weights:
+            self.source_weights = [float(w) for w in config.dataset_weights.split(',')]
+            assert(len(self.source_weights) == len(self.sources))
         else:
-            self.paths = sorted(glob("{}/{}/*".format(self.root, config.data_type[0])))
+            self.source_weights = self.source_sizes
+        if len(self.sources) > 1:
+            # samples of a mix carry the index of their dataset
+            self.paths = [(i, p) for i, (_, _, paths) in enumerate(self.sources) for p in paths]
+            print('%s: mix %s with weights %s' % (datetime.now(),
+                ', '.join(['%s (%d)' % (r, len(p)) for r, _, p in self.sources]), self.source_weights))
 
         self.num_samples = len(self.paths)
         assert(self.num_samples > 0)
+
+        # per-scene chunks for sequential reads, see data_tool.py --mode=chunk
+        self.scenes = None
+        if has_chunks(self.root, config.data_type):
+            self.scenes = SceneChunks(self.root, config.data_type)
         self.batch_size = config.batch_size
-        self.epochs_per_step = self.batch_size / float(self.num_samples) # per epoch
+        # data-parallel replicas (--num_replicas) read disjoint shards of the stream
+        self.replica = getattr(config, 'replica', 0)
+        self.num_replicas = config.num_replicas if config.is_train else 1
+        # every optimizer step takes accum_steps batches of batch_size samples
+        # (per replica) of a per-epoch permutation
+        self.accum_steps = config.accum_steps if config.is_train else 1
+        self.step_samples = self.batch_size*self.num_replicas*self.accum_steps
+        self.epochs_per_step = self.step_samples / float(self.num_samples) # per epoch
+        self.seed = config.random_seed
+        self.start_sample = config.start_step * self.step_samples
 
         self.data_type = config.data_type
         if self.data_type == 'velocity':
@@ -66,46 +90,130 @@ class BatchManager(object):
             feature_dim = [self.res_z, self.res_y, self.res_x, self.depth]
         else:
             feature_dim = [self.res_y, self.res_x, self.depth]
+        if self.manifest is not None:
+            assert list(self.manifest['x_shape']) == feature_dim, \
+                'dataset shape %s does not match %s' % (self.manifest['x_shape'], feature_dim)
 
         if 'ae' in config.arch:
             self.dof = int(self.args['num_dof'])
-            label_dim = [self.dof, int(self.args['num_frames'])]
+            label_dim = [self.dof, 1] # current parameters only
         else:
             label_dim = [self.c_num]
 
-        if self.is_3d:
-            min_after_dequeue = 500
+        # ground-truth jacobians from data_tool.py --mode=pack --jaco, fed as a third tensor
+        self.jaco = config.precomputed_jaco
+        self.jaco_dim = None
+        if self.jaco:
+            if self.data_format != 'packed' or config.data_type != 'velocity':
+                raise Exception("[!] Precomputed jacobians need packed velocity data")
+            if config.num_proc > 0:
+                raise Exception("[!] Precomputed jacobians are not decoded with --num_proc")
+            self.jaco_dim = feature_dim[:-1] + [self.depth**2]
+        self.sample_dims = [feature_dim, label_dim] + ([self.jaco_dim] if self.jaco else [])
+
+        # float32 features, labels (and jacobians)
+        self.sample_bytes = 4*int(sum([np.prod(d) for d in self.sample_dims]))
+        self.prefetch_mb = config.prefetch_mb
+        if self.prefetch_mb > 0:
+            capacity = max(int(self.prefetch_mb*2**20 // self.sample_bytes), 3 * self.batch_size)
+            print('%s: queue capacity %d (%.1f MB per sample)' % (
+                datetime.now(), capacity, self.sample_bytes/float(2**20)))
         else:
-            min_after_dequeue = 5000
-        capacity = min_after_dequeue + 3 * self.batch_size
-        self.q = tf.FIFOQueue(capacity, [tf.float32, tf.float32], [feature_dim, label_dim])
-        self.x = tf.placeholder(dtype=tf.float32, shape=feature_dim)
-        self.y = tf.placeholder(dtype=tf.float32, shape=label_dim)
-        self.enqueue = self.q.enqueue([self.x, self.y])
+            if self.is_3d:
+                min_after_dequeue = 500
+            else:
+                min_after_dequeue = 5000
+            capacity = min_after_dequeue + 3 * self.batch_size
+        self.capacity = capacity
+        self.feature_dim = feature_dim
+        self.label_dim = label_dim
         self.num_threads = np.amin([config.num_worker, multiprocessing.cpu_count(), self.batch_size])
-
-        r = np.loadtxt(os.path.join(self.root, self.data_type[0]+'_range.txt'))
-        self.x_range = max(abs(r[0]), abs(r[1]))
-        self.y_range = []
-        self.y_num = []
-
-        if 'ae' in config.arch:
-            for i in range(self.c_num):
-                p_name = self.args['p%d' % i]
-                p_min = float(self.args['min_{}'.format(p_name)])
-                p_max = float(self.args['max_{}'.format(p_name)])
-                p_num = int(self.args['num_{}'.format(p_name)])
-                self.y_num.append(p_num)
-            for i in range(label_dim[0]):
-                self.y_range.append([-1, 1])
+        self.num_proc = config.num_proc
+        self.decoder = None
+
+        self.input_pipeline = config.input_pipeline
+        if self.input_pipeline == 'queue':
+            self.q = tf.FIFOQueue(capacity, [tf.float32]*len(self.sample_dims), self.sample_dims)
+            self.x = tf.placeholder(dtype=tf.float32, shape=feature_dim)
+            self.y = tf.placeholder(dtype=tf.float32, shape=label_dim)
+            self.inputs = [self.x, self.y]
+            if self.jaco:
+                self.j = tf.placeholder(dtype=tf.float32, shape=self.jaco_dim)
+                self.inputs.append(self.j)
+            self.enqueue = self.q.enqueue(self.inputs)
+
+        # the generator doesn't know the dataset of a sample, so a mix shares
+        # one normalization: the largest range of the datasets and the same
+        # parameter ranges. generated samples denormalize with it
+        self.x_range = max([read_range(root, self.data_type) for root, _, _ in self.sources])
+        self.y_range, self.y_num = param_ranges(self.args, config.arch, label_dim)
+        for root, args, _ in self.sources[1:]:
+            if not np.allclose(param_ranges(args, config.arch, label_dim)[0], self.y_range):
+                raise Exception("[!] Parameter ranges of %s don't match %s" % (root, self.root))
+
+        # random aligned sub-volumes, aligned to the coarsest generator level
+        self.crop = None
+        if config.crop_x > 0 or config.crop_y > 0 or config.crop_z > 0:
+            if not self.is_3d or 'ae' in config.arch:
+                raise Exception("[!] Cropping is only supported for 3d generators")
+            self.crop = [c if c > 0 else f for c, f in zip(
+                [config.crop_z, config.crop_y, config.crop_x], feature_dim[:3])]
+            repeat_num = config.repeat
+            if repeat_num == 0:
+                repeat_num = int(np.log2(np.max(feature_dim[:3]))) - 2
+            self.crop_align = np.power(2, repeat_num-1)
+            for c, f in zip(self.crop, feature_dim[:3]):
+                if c > f or c % self.crop_align != 0:
+                    raise Exception("[!] Crop %s must fit into %s and be a multiple of %d" % (
+                        self.crop, feature_dim[:3], self.crop_align))
+
+        if len(self.sources) == 1:
+            self.reader = SampleReader(self.root, self.data_type, self.x_range, self.y_range,
+                                       data_format=self.data_format, cache_mb=config.cache_mb,
+                                       jaco=self.jaco)
         else:
-            for i in range(self.c_num):
-                p_name = self.args['p%d' % i]
-                p_min = float(self.args['min_{}'.format(p_name)])
-                p_max = float(self.args['max_{}'.format(p_name)])
-                p_num = int(self.args['num_{}'.format(p_name)])
-                self.y_range.append([p_min, p_max])
-                self.y_num.append(p_num)
+            # only datasets of the same resolution can be mixed, samples are not resampled
+            readers = []
+            for root, args, paths in self.sources:
+                shape = sample_shape(root, self.data_type, paths, self.data_format)
+                if list(shape) != feature_dim:
+                    raise Exception("[!] Samples of %s are %s, not %s" % (root, shape, feature_dim))
+                readers.append(SampleReader(root, self.data_type, self.x_range, self.y_range,
+                                            data_format=self.data_format, jaco=self.jaco))
+            self.reader = MixedReader(readers, cache_mb=config.cache_mb)
+
+        if self.input_pipeline == 'dataset':
+            self.iterator = self.build_dataset().make_one_shot_iterator()
+
+    def sampler(self, worker=0, num_workers=1):
+        worker = worker*self.num_replicas + self.replica
+        num_workers *= self.num_replicas
+        if len(self.sources) > 1:
+            return MixedSampler(self.source_sizes, self.source_weights, self.seed,
+                                self.start_sample, worker, num_workers)
+        return EpochSampler(len(self.paths), self.seed, self.start_sample, worker, num_workers)
+
+    def sample_ids(self):
+        return self.sampler()
+
+    def build_dataset(self):
+        def load(id):
+            return [a.astype(np.float32, copy=False) for a in self.reader.load(self.paths[id])]
+
+        def set_shape(*sample):
+            for a, dim in zip(sample, self.sample_dims):
+                a.set_shape(dim)
+            return sample
+
+        dtypes = [tf.float32]*len(self.sample_dims)
+        dataset = tf.data.Dataset.from_generator(self.sample_ids, tf.int64, tf.TensorShape([]))
+        dataset = dataset.map(lambda id: tuple(tf.py_func(load, [id], dtypes)),
+                              num_parallel_calls=self.num_threads)
+        dataset = dataset.map(set_shape)
+        dataset = dataset.batch(self.batch_size, drop_remainder=True)
+        if self.prefetch_mb > 0:
+            return dataset.prefetch(max(self.capacity // self.batch_size, 1))
+        return dataset.prefetch(2)
 
     def __del__(self):
         try:
@@ -114,34 +222,68 @@ class BatchManager(object):
             pass
 
     def start_thread(self, sess):
+        self.sess = sess
+        if self.input_pipeline == 'dataset':
+            # tf.data runs its own map threads
+            return
+
         print('%s: start to enque with %d threads' % (datetime.now(), self.num_threads))
 
         # Main thread: create a coordinator.
-        self.sess = sess
         self.coord = tf.train.Coordinator()
 
         # Create a method for loading and enqueuing
-        def load_n_enqueue(sess, enqueue, coord, paths, rng,
-                           x, y, data_type, x_range, y_range):
+        def load_n_enqueue(sess, enqueue, coord, paths, sampler,
+                           inputs, reader):
             with coord.stop_on_exception():
                 while not coord.should_stop():
-                    id = rng.randint(len(paths))
-                    x_, y_ = preprocess(paths[id], data_type, x_range, y_range)
-                    sess.run(enqueue, feed_dict={x: x_, y: y_})
+                    id = next(sampler)
+                    sample = reader.load(paths[id])
+                    sess.run(enqueue, feed_dict=dict(zip(inputs, sample)))
+
+        # Or only hand samples decoded by worker processes over to tf
+        def hand_over(sess, enqueue, coord, samples, decoder, reader, x, y):
+            with coord.stop_on_exception():
+                while not coord.should_stop():
+                    try:
+                        slot, hit, cache_size = samples.next(timeout=1)
+                    except multiprocessing.TimeoutError:
+                        continue
+                    sess.run(enqueue, feed_dict={x: decoder.xs[slot], y: decoder.ys[slot]})
+                    decoder.release(slot)
+                    if reader.cache_bytes > 0: reader.count(hit, cache_size)
+
+        def paths(coord, paths, sampler):
+            while not coord.should_stop():
+                yield paths[next(sampler)]
 
         # Create threads that enqueue
-        self.threads = [threading.Thread(target=load_n_enqueue,
-                                          args=(self.sess,
-                                                self.enqueue,
-                                                self.coord,
-                                                self.paths,
-                                                self.rng,
-                                                self.x,
-                                                self.y,
-                                                self.data_type,
-                                                self.x_range,
-                                                self.y_range)
-                                          ) for i in range(self.num_threads)]
+        if self.num_proc > 0:
+            print('%s: decode with %d processes' % (datetime.now(), self.num_proc))
+            num_slots = 2*self.num_proc + self.num_threads
+            self.decoder = SampleDecoder(self.reader, self.num_proc, num_slots,
+                                         self.feature_dim, self.label_dim)
+            samples = self.decoder.imap(paths(self.coord, self.paths, self.sampler()), self.coord)
+            self.threads = [threading.Thread(target=hand_over,
+                                              args=(self.sess,
+                                                    self.enqueue,
+                                                    self.coord,
+                                                    samples,
+                                                    self.decoder,
+                                                    self.reader,
+                                                    self.x,
+                                                    self.y)
+                                              ) for i in range(self.num_threads)]
+        else:
+            self.threads = [threading.Thread(target=load_n_enqueue,
+                                              args=(self.sess,
+                                                    self.enqueue,
+                                                    self.coord,
+                                                    self.paths,
+                                                    self.sampler(i, self.num_threads),
+                                                    self.inputs,
+                                                    self.reader)
+                                              ) for i in range(self.num_threads)]
 
         # define signal handler
         def signal_handler(signum, frame):
@@ -151,6 +293,7 @@ class BatchManager(object):
             self.coord.request_stop()
             self.sess.run(self.q.close(cancel_pending_enqueues=True))
             self.coord.join(self.threads)
+            if self.decoder is not None: self.decoder.close()
             sys.exit(1)
         signal.signal(signal.SIGINT, signal_handler)
 
@@ -159,6 +302,9 @@ class BatchManager(object):
             t.start()
 
     def stop_thread(self):
+        if self.input_pipeline == 'dataset':
+            return
+
         # dirty way to bypass graph finilization error
         g = tf.get_default_graph()
         g._finalized = False
@@ -166,37 +312,120 @@ class BatchManager(object):
         self.coord.request_stop()
         self.sess.run(self.q.close(cancel_pending_enqueues=True))
         self.coord.join(self.threads)
+        if self.decoder is not None:
+            self.decoder.close()
+            self.decoder = None
 
     def batch(self):
-        return self.q.dequeue_many(self.batch_size)
-
-    def batch_(self, b_num):
-        assert(len(self.paths) % b_num == 0)
-        x_batch = []
-        y_batch = []
-        for i, filepath in enumerate(self.paths):
-            x, _ = preprocess(filepath, self.data_type, self.x_range, self.y_range)
-            x_batch.append(x)
-
-            if (i+1) % b_num == 0:
-                yield np.array(x_batch), y_batch
-                x_batch.clear()
-                y_batch.clear()
+        # tensors of a dequeued batch: x, y, the precomputed jacobians x_jaco
+        # and the crop_offset of the sub-volumes if any
+        if self.input_pipeline == 'dataset':
+            sample = self.iterator.get_next()
+        else:
+            sample = self.q.dequeue_many(self.batch_size)
+        batch = {'x': sample[0], 'y': sample[1]}
+        if self.jaco: batch['x_jaco'] = sample[2]
+        if self.crop is None:
+            return batch
+        offset = self.random_offset()
+        batch['crop_offset'] = offset
+        for k in ['x', 'x_jaco']:
+            if k in batch: batch[k] = self.crop_at(batch[k], offset)
+        return batch
+
+    def random_offset(self):
+        # per-sample aligned offsets of the sub-volumes, also for the generator
+        offset = []
+        for f, c in zip(self.feature_dim[:3], self.crop):
+            num_offsets = (f - c) // self.crop_align + 1
+            offset.append(tf.random_uniform([self.batch_size], 0, num_offsets, dtype=tf.int32))
+        return tf.stack(offset, axis=1) * self.crop_align
+
+    def crop_at(self, x, offset):
+        offset = tf.concat([offset, tf.zeros([self.batch_size, 1], tf.int32)], axis=1)
+        return tf.stack([tf.slice(x[i], offset[i], self.crop + [-1]) for i in range(self.batch_size)])
+
+    def summary(self):
+        rss = tf.py_func(lambda: np.float32(get_rss_mb()), [], tf.float32)
+        summary = [
+            tf.summary.scalar('misc/rss_mb', rss),
+        ]
+        if self.reader.cache_bytes > 0:
+            hit_rate, cache_mb = tf.py_func(
+                lambda: (np.float32(self.reader.hit_rate()),
+                         np.float32(self.reader.total_cache_size()/float(2**20))),
+                [], [tf.float32, tf.float32])
+            summary += [
+                tf.summary.scalar('misc/cache_hit_rate', hit_rate),
+                tf.summary.scalar('misc/cache_mb', cache_mb),
+            ]
+        if self.input_pipeline == 'dataset':
+            return summary
+
+        q_size = self.q.size()
+        summary += [
+            tf.summary.scalar('misc/q', q_size),
+            tf.summary.scalar('misc/q_fill', tf.cast(q_size, tf.float32) / self.capacity),
+            tf.summary.scalar('misc/q_mb', tf.cast(q_size, tf.float32) * self.sample_bytes / 2**20),
+        ]
+        return summary
+
+    def batch_(self, b_num, scenes=None):
+        # frames of all (or the given) scenes in scene-major order, decoded ahead
+        # by worker processes (a whole scene per task if chunked). the last
+        # batch is zero-padded, mask marks its valid rows
+        num_proc = self.num_proc if self.num_proc > 0 else multiprocessing.cpu_count()
+        if self.scenes is None:
+            tasks, chunksize = self.paths, 8
+            if scenes is not None:
+                nf = int(self.args['num_frames'])
+                tasks = [p for i in scenes for p in self.paths[i*nf:(i+1)*nf]]
+        else:
+            tasks, chunksize = self.scenes.scenes, 1
+            if scenes is not None:
+                tasks = [tasks[i] for i in scenes]
+        pool = multiprocessing.Pool(num_proc, initializer=init_reader,
+                                    initargs=(self.reader, self.scenes))
+
+        t0 = time.time()
+        num_frames = 0
+        x_batch = np.zeros([b_num] + self.feature_dim, dtype=np.float32)
+        n = 0
+        try:
+            for xs in pool.imap(decode_frames, tasks, chunksize=chunksize):
+                for x in xs:
+                    x_batch[n] = x
+                    n += 1
+                    if n == b_num:
+                        num_frames += n
+                        yield x_batch, np.ones(b_num, dtype=bool)
+                        x_batch = np.zeros_like(x_batch)
+                        n = 0
+            if n > 0:
+                num_frames += n
+                yield x_batch, np.arange(b_num) < n
+        finally:
+            pool.terminate()
+            pool.join()
+
+        sec = time.time() - t0
+        print('%s: %d frames in %.1f sec (%.1f frames/sec, %d processes)' % (
+            datetime.now(), num_frames, sec, num_frames / max(sec, 1e-6), num_proc))
 
     def denorm(self, x=None, y=None):
-        # input range [-1, 1] -> original range
+        # input range [-1, 1] -> original range (shared by the datasets of a mix)
+        x_range, y_range = self.x_range, self.y_range
 
         # print('data.denorm: self.x_range: %s' % self.x_range)
         # print('data.denorm: x[0,0,0,0]: Pre x_range scaling: %s' % x[0,0,0,0])
 
         if x is not None:
-            x *= self.x_range
+            x *= x_range
 
         # print('data.denorm: x[0,0,0,0]: Post x_range scaling: %s' % x[0,0,0,0])
 
         if y is not None:
-            r = self.y_range
-            for i, ri in enumerate(self.y_range):
+            for i, ri in enumerate(y_range):
                 y[:,i] = (y[:,i]+1) * 0.5 * (ri[1]-ri[0]) + ri[0]
         return x, y
 
@@ -205,105 +434,54 @@ class BatchManager(object):
         filelist = []
         for p in p_list:
             filelist.append(path_format % tuple(p))
+        if len(self.sources) > 1:
+            # the first dataset, in the form of the mixed paths
+            filelist = [(0, f) for f in filelist]
         return filelist
 
+    def load_list(self, paths):
+        # decode in parallel, zlib releases the GIL
+        pool = ThreadPool(max(min(len(paths), multiprocessing.cpu_count()), 1))
+        samples = pool.map(self.reader.load, paths)
+        pool.close()
+        return [np.array(a) for a in zip(*samples)] # x, y (, j)
+
+    def random_p(self, num):
+        p = [[self.rng.randint(y_max) for y_max in self.y_num] for _ in range(num)]
+        z = [[(pi/float(self.y_num[i]-1))*2-1 for i, pi in enumerate(p_)] for p_ in p] # [-1,1]
+        return p, z
+
     def random_list2d(self, num):
-        xs = []
-        pis = []
-        zis = []
-        for _ in range(num):
-            pi = []
-            for y_max in self.y_num:
-                pi.append(self.rng.randint(y_max))
-
-            filepath = self.list_from_p([pi])[0]
-            x, y = preprocess(filepath, self.data_type, self.x_range, self.y_range)
-            if self.data_type[0] == 'v':
-                b_ch = np.zeros((self.res_y, self.res_x, 1))
-                x = np.concatenate((x, b_ch), axis=-1)
-            elif self.data_type[0] == 'l':
-                offset = 0.5
-                eps = 1e-3
-                x[x<(offset+eps)] = -1
-                x[x>-1] = 1
-            x = np.clip((x+1)*127.5, 0, 255)
-            zi = [(p/float(self.y_num[i]-1))*2-1 for i, p in enumerate(pi)] # [-1,1]
-
-            xs.append(x)
-            pis.append(pi)
-            zis.append(zi)
-        return np.array(xs), pis, zis
+        pis, zis = self.random_p(num)
+        x = self.load_list(self.list_from_p(pis))[0]
+        if self.data_type[0] == 'v':
+            b_ch = np.zeros(x.shape[:-1] + (1,))
+            x = np.concatenate((x, b_ch), axis=-1)
+        elif self.data_type[0] == 'l':
+            offset = 0.5
+            eps = 1e-3
+            x = np.where(x<(offset+eps), -1.0, 1.0)
+        x = np.clip((x+1)*127.5, 0, 255)
+        return x, pis, zis
 
     def random_list3d(self, num):
-        sample = {
-            'x': [],
-            'y': [],
-            'xy': [],
-            'zy': [],
-            'xym': [],
-            'zym': [],
-            'xy_c': [],
-            'zy_c': [],
-            'xym_c': [],
-            'zym_c': [],
-            'xy_w': [],
-            'zy_w': [],
-            'xym_w': [],
-            'zym_w': [],
-            'p': [],
-            'z': [],
-        }
+        p, z = self.random_p(num)
+        sample_ = self.load_list(self.list_from_p(p))
+        x, y = sample_[:2]
+        sample = {'x': x, 'y': y, 'p': p, 'z': z}
+
+        # vorticity
+        if self.jaco:
+            x_c = vort_from_jaco_np(sample_[2])
+        else:
+            _, x_c = jacobian_np3(x)
 
-        for _ in range(num):
-            p = []
-            for y_max in self.y_num:
-                p.append(self.rng.randint(y_max))
-            sample['p'].append(p)
-            z = [(pi/float(self.y_num[i]-1))*2-1 for i, pi in enumerate(p)] # [-1,1]
-            sample['z'].append(z)
-
-            file_path = self.list_from_p([p])[0]
-            x, y = preprocess(file_path, self.data_type, self.x_range, self.y_range)
-            sample['x'].append(x)
-            sample['y'].append(y)
-
-            xy = plane_view_np(x, xy_plane=True, project=True)
-            zy = plane_view_np(x, xy_plane=False, project=True)
-            xym = plane_view_np(x, xy_plane=True, project=False)
-            zym = plane_view_np(x, xy_plane=False, project=False)
-
-            sample['xy'].append(xy)
-            sample['zy'].append(zy)
-            sample['xym'].append(xym)
-            sample['zym'].append(zym)
-
-            # vorticity
-            x_c = np.expand_dims(x, axis=0)
-            _, x_c = jacobian_np3(x_c)
-
-            x_c = np.squeeze(x_c, axis=0)
-            xy_c = plane_view_np(x_c, xy_plane=True, project=True)
-            zy_c = plane_view_np(x_c, xy_plane=False, project=True)
-            xym_c = plane_view_np(x_c, xy_plane=True, project=False)
-            zym_c = plane_view_np(x_c, xy_plane=False, project=False)
-
-            sample['xy_c'].append(xy_c)
-            sample['zy_c'].append(zy_c)
-            sample['xym_c'].append(xym_c)
-            sample['zym_c'].append(zym_c)
-
-        sample['x'] = np.array(sample['x'])
-        sample['y'] = np.array(sample['y'])
-
-        sample['xy'] = np.array(sample['xy'])
-        sample['zy'] = np.array(sample['zy'])
-        sample['xym'] = np.array(sample['xym'])
-        sample['zym'] = np.array(sample['zym'])
-
-        sample['xy_c'] = np.array(sample['xy_c'])
-        sample['zy_c'] = np.array(sample['zy_c'])
-        sample['xym_c'] = np.array(sample['xym_c'])
-        sample['zym_c'] = np.array(sample['zym_c'])
+        # plane views of the whole [b,z,y,x,d] stack at once
+        for k, v in [('', x), ('_c', x_c)]:
+            sample['xy'+k] = plane_view_np(v, xy_plane=True, project=True)
+            sample['zy'+k] = plane_view_np(v, xy_plane=False, project=True)
+            sample['xym'+k] = plane_view_np(v, xy_plane=True, project=False)
+            sample['zym'+k] = plane_view_np(v, xy_plane=False, project=False)
 
         return sample
 
@@ -314,10 +492,253 @@ class BatchManager(object):
             return self.random_list2d(num)
 
 
+class SampleReader(object):
+    def __init__(self, root, data_type, x_range, y_range, data_format='npz', cache_mb=0, jaco=False):
+        self.data_type = data_type
+        self.x_range = x_range
+        self.y_range = y_range
+        self.data_format = data_format
+
+        # LRU cache of decoded, normalized samples
+        self.cache_bytes = int(cache_mb*2**20)
+        self.cache = OrderedDict()
+        self.cache_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.worker_cache_size = {} # of the caches in worker processes, by pid
+        self.lock = threading.Lock()
+
+        if self.data_format == 'packed':
+            self.x_path, y_path, index_path = packed_files(root, data_type)
+            self.index = {n: i for i, n in enumerate(read_index(index_path))}
+            self.ys = np.load(y_path)
+            self.xs = None # opened on first use
+            self.j_path = jaco_file(root, data_type) if jaco else None
+            self.js = None
+            # packed samples are normalized with the range of their own dataset
+            self.x_scale = 1.0 if data_type[0] == 'd' else read_range(root, data_type) / x_range
+
+    def __getstate__(self):
+        # memmaps are reopened lazily and caches start empty in worker processes
+        state = self.__dict__.copy()
+        if 'xs' in state: state['xs'] = None
+        if 'js' in state: state['js'] = None
+        state['cache'] = OrderedDict()
+        state['cache_size'] = 0
+        state['worker_cache_size'] = {}
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def load(self, file_path):
+        if self.cache_bytes == 0:
+            return self.decode(file_path)
+
+        with self.lock:
+            sample = self.cache.get(file_path)
+            if sample is not None:
+                self.cache.move_to_end(file_path)
+                self.hits += 1
+                return sample
+
+        sample = self.decode(file_path)
+        sample_bytes = sum([a.nbytes for a in sample])
+        with self.lock:
+            self.misses += 1
+            if file_path not in self.cache:
+                self.cache[file_path] = sample
+                self.cache_size += sample_bytes
+            while self.cache_size > self.cache_bytes:
+                _, old = self.cache.popitem(last=False)
+                self.cache_size -= sum([a.nbytes for a in old])
+        return sample
+
+    def count(self, hit, cache_size):
+        # for hits, misses and sizes of caches in worker processes
+        pid, size = cache_size
+        with self.lock:
+            if hit: self.hits += 1
+            else: self.misses += 1
+            self.worker_cache_size[pid] = size
+
+    def total_cache_size(self):
+        if self.worker_cache_size:
+            return sum(self.worker_cache_size.values())
+        return self.cache_size
+
+    def hit_rate(self):
+        return self.hits / float(max(self.hits + self.misses, 1))
+
+    def decode(self, file_path):
+        if self.data_format == 'npz':
+            return preprocess(file_path, self.data_type, self.x_range, self.y_range)
+
+        if self.xs is None:
+            self.xs = np.load(self.x_path, mmap_mode='r')
+        i = self.index[os.path.basename(file_path)]
+        x = np.asarray(self.xs[i], dtype=np.float32) # zero-copy for float32
+        if self.x_scale != 1: x = x * self.x_scale
+        y = normalize_y(current_label(self.ys[i]).astype(np.float32), self.y_range)
+        if self.j_path is None:
+            return x, y
+        if self.js is None:
+            self.js = np.load(self.j_path, mmap_mode='r')
+        j = np.asarray(self.js[i], dtype=np.float32)
+        if self.x_scale != 1: j = j * self.x_scale
+        return x, y, j
+
+class MixedReader(SampleReader):
+    # (dataset index, path) samples of several datasets, decoded by the
+    # reader of their dataset, sharing one cache
+    def __init__(self, readers, cache_mb=0):
+        r = readers[0]
+        super(MixedReader, self).__init__(None, r.data_type, r.x_range, r.y_range, cache_mb=cache_mb)
+        self.readers = readers
+
+    def decode(self, sample):
+        i, file_path = sample
+        return self.readers[i].decode(file_path)
+
+class SampleDecoder(object):
+    # decodes samples in worker processes into shared-memory slots, so that
+    # the enqueue threads only hand finished arrays over to tf
+    def __init__(self, reader, num_proc, num_slots, x_dim, y_dim):
+        x_buf = multiprocessing.RawArray('f', num_slots*int(np.prod(x_dim)))
+        y_buf = multiprocessing.RawArray('f', num_slots*int(np.prod(y_dim)))
+        self.xs = np.frombuffer(x_buf, dtype=np.float32).reshape([num_slots]+x_dim)
+        self.ys = np.frombuffer(y_buf, dtype=np.float32).reshape([num_slots]+y_dim)
+
+        self.free = queue.Queue()
+        for slot in range(num_slots):
+            self.free.put(slot)
+
+        self.pool = multiprocessing.Pool(num_proc, init_decoder,
+                                         (reader, x_buf, y_buf, x_dim, y_dim))
+
+    def imap(self, paths, coord):
+        def tasks():
+            for file_path in paths:
+                while not coord.should_stop():
+                    try:
+                        slot = self.free.get(timeout=1)
+                    except queue.Empty:
+                        continue
+                    yield slot, file_path
+                    break
+        return self.pool.imap_unordered(decode_to_slot, tasks())
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+_decoder = {}
+
+def init_decoder(reader, x_buf, y_buf, x_dim, y_dim):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _decoder['reader'] = reader
+    _decoder['xs'] = np.frombuffer(x_buf, dtype=np.float32).reshape([-1]+x_dim)
+    _decoder['ys'] = np.frombuffer(y_buf, dtype=np.float32).reshape([-1]+y_dim)
+
+def init_reader(reader, scenes):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _decoder['reader'] = reader
+    _decoder['scenes'] = scenes
+
+def decode_frames(task):
+    # a frame file or a chunked scene -> [n, ...] normalized frames
+    reader = _decoder['reader']
+    scenes = _decoder['scenes']
+    if scenes is None:
+        return reader.decode(task)[0][None]
+    x, _ = scenes.scene(task)
+    return normalize_x(x, reader.data_type, reader.x_range)
+
+def decode_to_slot(task):
+    slot, file_path = task
+    reader = _decoder['reader']
+    hits = reader.hits
+    x, y = reader.load(file_path)
+    _decoder['xs'][slot] = x
+    _decoder['ys'][slot] = y
+    return slot, reader.hits > hits, (os.getpid(), reader.cache_size)
+
+def list_paths(root, args, config):
+    # sample paths of a dataset and its manifest if any
+    manifest = None
+    if config.data_format == 'packed':
+        # packed rows are already in scene-major order
+        _, _, index_path = packed_files(root, config.data_type)
+        paths = [os.path.join(root, config.data_type[0], n)
+                 for n in read_index(index_path)]
+    elif manifest_is_current(root, config.data_type):
+        # manifest names are already in scene-major order
+        manifest = read_manifest(root, config.data_type)
+        paths = [os.path.join(root, config.data_type[0], n)
+                 for n in manifest['names']]
+    elif 'ae' in config.arch:
+        def sortf(x):
+            nf = int(args['num_frames'])
+            n = os.path.basename(x)[:-4].split('_')
+            return int(n[0])*nf + int(n[1])
+
+        paths = sorted(glob("{}/{}/*".format(root, config.data_type[0])),
+                       key=sortf)
+        # num_path = len(paths)
+        # num_train = int(num_path*0.95)
+        # test_paths = paths[num_train:]
+        # paths = paths[:num_train]
+    else:
+        paths = sorted(glob("{}/{}/*".format(root, config.data_type[0])))
+
+    if manifest is None and config.data_format != 'packed' and \
+        os.path.exists(manifest_file(root, config.data_type)):
+        print('%s: %s is older than the dataset, scanned the directory instead (rewrite it with --mode=manifest)' % (
+            datetime.now(), manifest_file(root, config.data_type)))
+    return paths, manifest
+
+def param_ranges(args, arch, label_dim):
+    # label ranges to normalize to [-1,1] and number of values per parameter
+    y_range = []
+    y_num = []
+    c_num = int(args['num_param'])
+    if 'ae' in arch:
+        for i in range(c_num):
+            p_name = args['p%d' % i]
+            p_num = int(args['num_{}'.format(p_name)])
+            y_num.append(p_num)
+        for i in range(label_dim[0]):
+            y_range.append([-1, 1])
+    else:
+        for i in range(c_num):
+            p_name = args['p%d' % i]
+            p_min = float(args['min_{}'.format(p_name)])
+            p_max = float(args['max_{}'.format(p_name)])
+            p_num = int(args['num_{}'.format(p_name)])
+            y_range.append([p_min, p_max])
+            y_num.append(p_num)
+    return y_range, y_num
+
+def sample_shape(root, data_type, paths, data_format):
+    if data_format == 'packed':
+        return np.load(packed_files(root, data_type)[0], mmap_mode='r').shape[1:]
+    with np.load(paths[0]) as data:
+        return data['x'].shape
+
+def normalize_y(y, y_range):
+    for i, ri in enumerate(y_range):
+        y[i] = (y[i]-ri[0]) / (ri[1]-ri[0]) * 2 - 1
+    return y
+
 def preprocess(file_path, data_type, x_range, y_range):
     with np.load(file_path) as data:
-        x = data['x']
-        y = data['y']
+        x = decode(data) # float32, dequantized
+        y = current_label(data['y'])
 
     # # ############## for old data
     # if x.ndim == 4:
@@ -329,13 +750,8 @@ def preprocess(file_path, data_type, x_range, y_range):
     #     x = x[::-1] # horizontal flip
 
     # normalize
-    if data_type[0] == 'd':
-        x = x*2 - 1
-    else:
-        x /= x_range
-
-    for i, ri in enumerate(y_range):
-        y[i] = (y[i]-ri[0]) / (ri[1]-ri[0]) * 2 - 1
+    x = normalize_x(x, data_type, x_range)
+    y = normalize_y(y, y_range)
     return x, y
 
 def test3d(config):
@@ -352,7 +768,7 @@ def test3d(config):
     sess = tf.Session(config=sess_config)
 
     batch_manager.start_thread(sess)
-    x, y = batch_manager.batch()
+    x = batch_manager.batch()['x']
     x_ = x.eval(session=sess)
     batch_manager.stop_thread()
 
@@ -370,6 +786,55 @@ def test3d(config):
         f.write(str(sample['p']))
         f.write(str(sample['z']))
 
+def bench_random_list(config):
+    prepare_dirs_and_logger(config)
+    batch_manager = BatchManager(config)
+
+    # batched vs. one sample at a time
+    for num in [4, 8, 16, 32, 64]:
+        t = time.time()
+        for _ in range(num):
+            batch_manager.random_list(1)
+        t_loop = time.time() - t
+
+        t = time.time()
+        batch_manager.random_list(num)
+        t_batch = time.time() - t
+        print('%d samples: loop %.3f sec, batch %.3f sec (x%.1f)' % (
+            num, t_loop, t_batch, t_loop/t_batch))
+
+def bench_jaco(config):
+    prepare_dirs_and_logger(config)
+
+    # input and target jacobians per batch on cpu, in-graph vs. precomputed
+    # (packed with data_tool.py --jaco)
+    for precomputed in [False, True]:
+        tf.reset_default_graph()
+        config.precomputed_jaco = precomputed
+        batch_manager = BatchManager(config)
+        batch = batch_manager.batch()
+        x = batch['x']
+        if precomputed:
+            x_jaco = batch['x_jaco']
+        elif config.is_3d:
+            x_jaco, _ = jacobian3(x)
+        else:
+            x_jaco, _ = jacobian(x)
+        loss = tf.reduce_mean(tf.abs(x_jaco))
+
+        sess = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+        batch_manager.start_thread(sess)
+        for _ in range(10):
+            sess.run(loss)
+        t = time.time()
+        for _ in range(100):
+            sess.run(loss)
+        t = (time.time() - t) / 100
+        print('precomputed %s: %.1f ms per batch, %.1f MB per sample, rss %.0f MB' % (
+            precomputed, t*1000, batch_manager.sample_bytes/float(2**20), get_rss_mb()))
+        batch_manager.stop_thread()
+        sess.close()
+
 def test2d(config):
     prepare_dirs_and_logger(config)
     tf.set_random_seed(config.random_seed)
@@ -384,7 +849,7 @@ def test2d(config):
     sess = tf.Session(config=sess_config)
     batch_manager.start_thread(sess)
 
-    x, y = batch_manager.batch() # [-1, 1]
+    x = batch_manager.batch()['x'] # [-1, 1]
     x_ = x.eval(session=sess)
     # y_ = y.eval(session=sess)
     batch_manager.stop_thread()
@@ -471,4 +936,6 @@ if __name__ == "__main__":
     # # setattr(config, 'arch', 'ae')
 
     # test3d(config)
+    # bench_random_list(config)
+    # bench_jaco(config)
     # ##############
\ No newline at end of file
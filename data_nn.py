@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 
 from tqdm import trange
 from ops import *
+from data_tool import code_dir, read_code_index
 
 class BatchManager(object):
     def __init__(self, config):
@@ -29,6 +30,7 @@ class BatchManager(object):
         self.z_num = config.z_num
         self.dof = int(self.args['num_dof'])
         self.code_path = os.path.join(config.code_path, 'code%d.npz' % self.z_num)
+        self.code_dir = code_dir(config.code_path, self.z_num)
         
         self.features_dim = [None, self.z_num+self.dof] # + x,y
         self.features_w_dim = [None, self.w_num, self.z_num+self.dof]
@@ -37,115 +39,173 @@ class BatchManager(object):
         self.labels_w_dim = [None, self.w_num, self.z_num]
         self.batch_size = config.batch_size
 
-        self.features_placeholder = tf.placeholder(tf.float32, self.features_dim)
-        self.labels_placeholder = tf.placeholder(tf.float32, self.labels_dim)
-        self.features_w_placeholder = tf.placeholder(tf.float32, self.features_w_dim)
-        self.labels_w_placeholder = tf.placeholder(tf.float32, self.labels_w_dim)
+        # load data
+        x, y = self.load_code()
 
-        train_dataset = tf.data.Dataset.from_tensor_slices((self.features_placeholder, self.labels_placeholder))\
-                    .batch(self.batch_size).repeat().shuffle(buffer_size=50)
-        
-        test_dataset = tf.data.Dataset.from_tensor_slices((self.features_placeholder, self.labels_placeholder))\
-                    .batch(self.batch_size)
+        self.num_train_scenes = int(self.num_scenes * 0.95)
+        self.num_test_scenes = self.num_scenes - self.num_train_scenes
+        self.num_train = self.num_train_scenes * (self.num_frames-1)
+        self.num_test = x.shape[0] - self.num_train
 
-        train_w_dataset = tf.data.Dataset.from_tensor_slices((self.features_w_placeholder, self.labels_w_placeholder))\
-                    .batch(self.batch_size).repeat().shuffle(buffer_size=50)
+        self.x_test, self.y_test = x[self.num_train:], y[self.num_train:]
+        self.x_train, self.y_train = x[:self.num_train], y[:self.num_train]
+                
+        # strided [n, w_num, d] views, windows are only copied at batch time
+        self.x_train_w = window_view(self.x_train, self.w_num)
+        self.y_train_w = window_view(self.y_train, self.w_num)
+        self.x_test_w = window_view(self.x_test, self.w_num)
+        self.y_test_w = window_view(self.y_test, self.w_num)
+        self.train_w_idx = window_starts(self.num_train_scenes, self.num_frames, self.w_num)
+        self.test_w_idx = window_starts(self.num_test_scenes, self.num_frames, self.w_num)
+
+        self.num_train_w = self.train_w_idx.shape[0]
+        self.num_test_w = self.test_w_idx.shape[0]
+        self.num_samples = self.num_train + self.num_test
         
-        test_w_dataset = tf.data.Dataset.from_tensor_slices((self.features_w_placeholder, self.labels_w_placeholder))\
-                    .batch(self.batch_size)
+        print('%s: # samples %d (train %d/test %d/batch size %d)' % (
+            datetime.now(), self.num_samples, self.num_train, self.num_test, self.batch_size))
+        self.train_steps = max(int(self.num_train / self.batch_size + 0.5), 1) # per epoch
+        self.train_w_steps = max(int(self.num_train_w / self.batch_size + 0.5), 1) # per epoch
+        # exactly one pass over the repeated test sets per evaluation
+        self.test_steps = int(np.ceil(self.num_test / self.batch_size)) # per epoch
+        self.test_w_steps = int(np.ceil(self.num_test_w / self.batch_size)) # per epoch
+
+        self.epochs_per_step = 1 / self.train_w_steps
+        self.c_num = 0
+
+        # datasets only carry indices, samples are gathered from the mapped arrays
+        train_dataset = self.dataset(self.x_train, self.y_train, self.num_train, True)
+        test_dataset = self.dataset(self.x_test, self.y_test, self.num_test, False)
+        train_w_dataset = self.dataset(self.x_train_w, self.y_train_w, self.num_train_w, True,
+                                       starts=self.train_w_idx)
+        test_w_dataset = self.dataset(self.x_test_w, self.y_test_w, self.num_test_w, False,
+                                      starts=self.test_w_idx)
         
         self.train_iterator = train_dataset.make_initializable_iterator()
         self.test_iterator = test_dataset.make_initializable_iterator()
         self.train_w_iterator = train_w_dataset.make_initializable_iterator()
         self.test_w_iterator = test_w_dataset.make_initializable_iterator()
 
-        # load data
+    def load_code(self):
+        # normalized codes are written once next to the code file and memory-mapped
+        prefix = self.code_path[:-4]
+        x_path, y_path, norm_path = prefix+'_x.npy', prefix+'_y.npy', prefix+'_norm.npz'
+        index_path = os.path.join(self.code_dir, 'index.txt')
+        src_path = index_path if os.path.exists(index_path) else self.code_path
+        if not os.path.exists(norm_path) or \
+            os.path.getmtime(norm_path) < os.path.getmtime(src_path):
+            print('%s: write normalized code to %s' % (datetime.now(), x_path))
+            if src_path == index_path:
+                self.normalize_shards(x_path, y_path, norm_path)
+            else:
+                self.normalize_code(x_path, y_path, norm_path)
+
+        with np.load(norm_path) as norm:
+            self.code_std = float(norm['code_std'])
+            self.out_std = float(norm['out_std'])
+            self.p_std = float(norm['p_std'])
+            self.num_scenes = int(norm['s'])
+            self.num_frames = int(norm['f'])
+
+        return np.load(x_path, mmap_mode='r'), np.load(y_path, mmap_mode='r')
+
+    def normalize_code(self, x_path, y_path, norm_path):
         code = np.load(self.code_path)
         x = code['x']
         y = code['y']
         p = code['p']
 
-        self.num_scenes = code['s']
-        self.num_frames = code['f']
-
-        self.code_std = np.std(x)
+        code_std = np.std(x)
         y -= x
-        self.out_std = np.std(y)
-        self.p_std = np.std(p)
-
-        x /= self.code_std
-        y /= self.out_std
-        p /= self.p_std
-
-        self.x_train = np.concatenate((x,p), axis=-1)
-        self.y_train = y
+        out_std = np.std(y)
+        p_std = np.std(p)
+
+        x /= code_std
+        y /= out_std
+        p /= p_std
+
+        np.save(x_path, np.concatenate((x,p), axis=-1).astype(np.float32))
+        np.save(y_path, y.astype(np.float32))
+        # written last, marks the cache as complete
+        np.savez(norm_path, code_std=code_std, out_std=out_std, p_std=p_std,
+                 s=code['s'], f=code['f'])
+
+    def normalize_shards(self, x_path, y_path, norm_path):
+        # two passes over the per-scene shards: running sums for the stds,
+        # then normalized rows written to the memory-mapped files
+        index = read_code_index(self.code_dir)
+        if not index:
+            raise Exception("[!] No encoded scenes in %s" % self.code_dir)
+        # codes of one encoder only: an interrupted encoding after a retrain
+        # leaves scenes of the previous checkpoint
+        ckpt = list(index.values())[-1]
+        stale = [scene for scene, c in index.items() if c != ckpt]
+        if stale:
+            raise Exception("[!] %d scenes in %s are not encoded with %s, encode them again" % (
+                len(stale), self.code_dir, ckpt))
+
+        scenes = sorted(index, key=int)
+        paths = [os.path.join(self.code_dir, '%s.npz' % i) for i in scenes]
+
+        sums = np.zeros([3, 3]) # x, y-x, p: count, sum, sum of squares
+        for path in paths:
+            with np.load(path) as code:
+                c, p = code['c'].astype(np.float64), code['p'].astype(np.float64)
+            for i, v in enumerate([c[:-1], c[1:]-c[:-1], p]):
+                sums[i] += [v.size, v.sum(), np.square(v).sum()]
+            num_frames = c.shape[0]
+        n, s, sq = sums.T
+        code_std, out_std, p_std = np.sqrt(np.maximum(sq/n - np.square(s/n), 0))
+
+        num_rows = len(paths)*(num_frames-1)
+        xs = np.lib.format.open_memmap(x_path, mode='w+', dtype=np.float32,
+                                       shape=(num_rows, self.z_num+self.dof))
+        ys = np.lib.format.open_memmap(y_path, mode='w+', dtype=np.float32,
+                                       shape=(num_rows, self.z_num))
+        for k, path in enumerate(paths):
+            with np.load(path) as code:
+                c, p = code['c'], code['p']
+            rows = slice(k*(num_frames-1), (k+1)*(num_frames-1))
+            xs[rows] = np.concatenate((c[:-1]/code_std, p/p_std), axis=-1)
+            ys[rows] = (c[1:]-c[:-1])/out_std
+        xs.flush()
+        ys.flush()
+        del xs, ys
+
+        # written last, marks the cache as complete
+        np.savez(norm_path, code_std=code_std, out_std=out_std, p_std=p_std,
+                 s=len(paths), f=num_frames)
+
+    def dataset(self, x, y, num, is_train, starts=None):
+        if starts is None:
+            x_dim, y_dim = self.features_dim, self.labels_dim
+        else:
+            x_dim, y_dim = self.features_w_dim, self.labels_w_dim
 
-        self.num_train_scenes = int(self.num_scenes * 0.95)
-        self.num_test_scenes = self.num_scenes - self.num_train_scenes
-        self.num_train = self.num_train_scenes * (self.num_frames-1)
-        self.num_test = self.x_train.shape[0] - self.num_train
+        def gather(idx):
+            if starts is not None:
+                idx = starts[idx]
+            return x[idx], y[idx]
 
-        self.x_test, self.y_test = self.x_train[self.num_train:], self.y_train[self.num_train:]
-        self.x_train, self.y_train = self.x_train[:self.num_train], self.y_train[:self.num_train]
-                
-        num_batches = self.num_train_scenes * (self.num_frames-self.w_num)
-        self.x_train_w = np.zeros(shape=[num_batches]+self.features_w_dim[1:])
-        self.y_train_w = np.zeros(shape=[num_batches]+self.labels_w_dim[1:])
-        k = 0
-        for i in range(self.num_train_scenes):
-            for j in range(self.num_frames-self.w_num):
-                idx = i*(self.num_frames-1) + j
-                # print('%d/%d: %d-%d' % (k, self.x_train_w.shape[0], idx, idx+self.w_num))
-                self.x_train_w[k,:,:] = self.x_train[idx:idx+self.w_num,:]
-                # self.y_train_w[k,:] = self.y_train[idx+self.w_num-1,:]
-                self.y_train_w[k,:,:] = self.y_train[idx:idx+self.w_num,:]
-                k += 1
-
-        num_batches = self.num_test_scenes * (self.num_frames-self.w_num)
-        self.x_test_w = np.zeros(shape=[num_batches]+self.features_w_dim[1:])
-        self.y_test_w = np.zeros(shape=[num_batches]+self.labels_w_dim[1:])
-        k = 0
-        for i in range(self.num_test_scenes):
-            for j in range(self.num_frames-self.w_num):
-                idx = i*(self.num_frames-1) + j
-                self.x_test_w[k,:,:] = self.x_test[idx:idx+self.w_num,:]
-                self.y_test_w[k,:,:] = self.y_test[idx:idx+self.w_num,:]
-                k += 1
-
-        self.num_train_w = self.x_train_w.shape[0]
-        self.num_test_w = self.x_test_w.shape[0]
-        self.num_samples = self.num_train + self.num_test
-        
-        print('%s: # samples %d (train %d/test %d/batch size %d)' % (
-            datetime.now(), self.num_samples, self.num_train, self.num_test, self.batch_size))
-        self.train_steps = max(int(self.num_train / self.batch_size + 0.5), 1) # per epoch
-        self.test_steps = max(int(self.num_test / self.batch_size + 0.5), 1) # per epoch
-        self.train_w_steps = max(int(self.num_train_w / self.batch_size + 0.5), 1) # per epoch
-        self.test_w_steps = max(int(self.num_test_w / self.batch_size + 0.5), 1) # per epoch
+        def load(idx):
+            x_, y_ = tf.py_func(gather, [idx], [tf.float32, tf.float32])
+            x_.set_shape(x_dim)
+            y_.set_shape(y_dim)
+            return x_, y_
 
-        self.epochs_per_step = 1 / self.train_w_steps
-        self.c_num = 0
+        d = tf.data.Dataset.range(num).batch(self.batch_size).repeat()
+        if is_train:
+            d = d.shuffle(buffer_size=50)
+        return d.map(load)
 
     def init_it(self, sess):
         print('%s: initialize train/test dataset iterator' % datetime.now())
                 
         self.sess = sess
-        self.sess.run(self.train_iterator.initializer,
-                 feed_dict={self.features_placeholder: self.x_train,
-                            self.labels_placeholder: self.y_train})
-        
-        self.sess.run(self.train_w_iterator.initializer,
-                 feed_dict={self.features_w_placeholder: self.x_train_w,
-                            self.labels_w_placeholder: self.y_train_w})
-
-    def init_test_it(self):
-        self.sess.run(self.test_iterator.initializer,
-                 feed_dict={self.features_placeholder: self.x_test,
-                            self.labels_placeholder: self.y_test})
-
-        self.sess.run(self.test_w_iterator.initializer,
-                 feed_dict={self.features_w_placeholder: self.x_test_w,
-                            self.labels_w_placeholder: self.y_test_w})
+        self.sess.run([self.train_iterator.initializer,
+                       self.train_w_iterator.initializer,
+                       self.test_iterator.initializer,
+                       self.test_w_iterator.initializer])
 
     def batch(self, is_window=False):
         if is_window:
@@ -159,6 +219,18 @@ class BatchManager(object):
         else:
             return self.test_iterator.get_next()
 
+def window_view(a, w_num):
+    # [n, d] -> [n-w_num+1, w_num, d] without copying
+    shape = (max(a.shape[0]-w_num+1, 0), w_num) + a.shape[1:]
+    strides = (a.strides[0],) + a.strides
+    return np.lib.stride_tricks.as_strided(a, shape=shape, strides=strides, writeable=False)
+
+def window_starts(num_scenes, num_frames, w_num):
+    # windows must not cross scene boundaries
+    s = np.arange(num_scenes)[:,None]*(num_frames-1)
+    f = np.arange(num_frames-w_num)[None,:]
+    return (s + f).reshape(-1)
+
 def main(config):
     prepare_dirs_and_logger(config)
     batch_manager = BatchManager(config)
@@ -179,7 +251,6 @@ def main(config):
     x_, y_ = sess.run([x, y])
     print(x_.shape, y_.shape)
 
-    batch_manager.init_test_it()
     x, y = batch_manager.test_batch()
     x_, y_ = sess.run([x, y])
     print(x_.shape, y_.shape)
@@ -0,0 +1,420 @@
+import os
+import io
+import shutil
+import argparse
+import multiprocessing
+from glob import glob
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+from tqdm import tqdm
+
+from scene.codec import codecs, encode, decode, error
+from scene.chunks import chunk_dir, scene_name
+
+def read_args(root):
+    # read data generation arguments
+    args = {}
+    with open(os.path.join(root, 'args.txt'), 'r') as f:
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            arg, arg_value = line[:-1].split(': ')
+            args[arg] = arg_value
+    return args
+
+def read_range(root, data_type):
+    r = np.loadtxt(os.path.join(root, data_type[0]+'_range.txt'))
+    return max(abs(r[0]), abs(r[1]))
+
+def param_key(file_path):
+    # '3_12.npz' -> (3, 12), scene-major order for sequence datasets
+    return tuple(int(n) for n in os.path.basename(file_path)[:-4].split('_'))
+
+def normalize_x(x, data_type, x_range):
+    if data_type[0] == 'd':
+        x = x*2 - 1
+    else:
+        x /= x_range
+    return x
+
+def current_label(y):
+    # [dof, num_frames] label histories (old ae datasets) -> [dof, 1]
+    y = np.asarray(y)
+    if y.ndim == 2:
+        y = y[:, -1:]
+    return y
+
+def label_history(root, scene, t, num_frames):
+    # [dof, num_frames] parameter history of frame t as in the old labels,
+    # from the per-scene parameters in n.npz, -1 before the first frame
+    with np.load(os.path.join(root, 'n.npz')) as data:
+        n = [data[k][scene] for k in ['nx', 'nz'] if k in data]
+    y = -np.ones([len(n), num_frames])
+    s = max(t+1-num_frames, 0)
+    for i, ni in enumerate(n):
+        y[i, num_frames-(t+1-s):] = ni[s:t+1]
+    return y
+
+def packed_files(root, data_type):
+    # x: pre-normalized samples, y: raw labels, index: file name per row
+    prefix = os.path.join(root, data_type[0]+'_packed')
+    return prefix+'.npy', prefix+'_y.npy', prefix+'.txt'
+
+def jaco_file(root, data_type):
+    # jacobians of the packed (normalized) samples, see pack(jaco=True)
+    return os.path.join(root, data_type[0]+'_packed_j.npy')
+
+def read_index(index_path):
+    with open(index_path, 'r') as f:
+        return f.read().split()
+
+def manifest_file(root, data_type):
+    return os.path.join(root, data_type[0]+'_manifest.npz')
+
+def scan(root, data_type):
+    paths = sorted(glob(os.path.join(root, data_type[0], '*.npz')), key=param_key)
+    assert(len(paths) > 0)
+    return paths
+
+def write_manifest(root, data_type):
+    # ordered file names, parameter indices, shapes and range of a dataset,
+    # so that loaders don't need to scan the directory
+    paths = scan(root, data_type)
+    with np.load(paths[0]) as data:
+        x_shape = data['x'].shape
+        y_shape = current_label(data['y']).shape
+
+    manifest_path = manifest_file(root, data_type)
+    np.savez(manifest_path,
+             names=np.array([os.path.basename(p) for p in paths]),
+             p=np.array([param_key(p) for p in paths]),
+             x_shape=np.array(x_shape),
+             y_shape=np.array(y_shape),
+             x_range=read_range(root, data_type))
+    print('%s: %d samples %s written to %s' % (
+        datetime.now(), len(paths), str(x_shape), manifest_path))
+
+def manifest_is_current(root, data_type):
+    # adding, removing or renaming files updates the mtime of the directory
+    manifest_path = manifest_file(root, data_type)
+    return os.path.exists(manifest_path) and \
+        os.path.getmtime(manifest_path) >= os.path.getmtime(os.path.join(root, data_type[0]))
+
+def read_manifest(root, data_type):
+    with np.load(manifest_file(root, data_type)) as data:
+        return {k: data[k] for k in data.files}
+
+def pack(root, data_type, dtype='float32', jaco=False):
+    paths = scan(root, data_type)
+    x_range = read_range(root, data_type)
+
+    with np.load(paths[0]) as data:
+        x_shape = data['x'].shape
+        y_shape = current_label(data['y']).shape
+
+    x_path, y_path, index_path = packed_files(root, data_type)
+    print('%s: pack %d samples %s (%s) to %s' % (
+        datetime.now(), len(paths), str(x_shape), dtype, x_path))
+
+    xs = np.lib.format.open_memmap(x_path, mode='w+', dtype=dtype,
+                                   shape=(len(paths),)+x_shape)
+    ys = np.zeros((len(paths),)+y_shape, dtype=np.float32)
+    if jaco:
+        if data_type != 'velocity':
+            raise Exception("[!] Jacobians are only packed for velocity")
+        # the training targets of the velocity gradient loss, ops pulls in tf
+        from ops import jacobian_np, jacobian_np3
+        jacobian_np_ = jacobian_np3 if len(x_shape) == 4 else jacobian_np
+        j_path = jaco_file(root, data_type)
+        js = np.lib.format.open_memmap(j_path, mode='w+', dtype=dtype,
+                                       shape=(len(paths),)+x_shape[:-1]+(x_shape[-1]**2,))
+        print('%s: jacobians to %s' % (datetime.now(), j_path))
+    for i, file_path in enumerate(tqdm(paths)):
+        with np.load(file_path) as data:
+            x = decode(data)
+            ys[i] = current_label(data['y'])
+        x = normalize_x(x, data_type, x_range)
+        xs[i] = x
+        if jaco:
+            js[i] = jacobian_np_(x[None])[0][0]
+    xs.flush()
+    del xs
+    if jaco:
+        js.flush()
+        del js
+
+    np.save(y_path, ys)
+    with open(index_path, 'w') as f:
+        f.write('\n'.join([os.path.basename(p) for p in paths]))
+    print('%s: done' % datetime.now())
+
+def chunk_scene(task):
+    paths, scene_path, dtype = task
+    xs, ys = [], []
+    for file_path in paths:
+        with np.load(file_path) as data:
+            xs.append(decode(data).astype(dtype))
+            ys.append(current_label(data['y']))
+    np.save(scene_path+'.npy', np.stack(xs))
+    np.save(scene_path+'_y.npy', np.stack(ys))
+
+def chunk(root, data_type, dtype, num_proc):
+    # one [num_frames, ...] array per scene, frames are not normalized
+    scenes = OrderedDict()
+    for file_path in scan(root, data_type):
+        scenes.setdefault(scene_name(param_key(file_path)[:-1]), []).append(file_path)
+
+    out_dir = chunk_dir(root, data_type)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    print('%s: chunk %d scenes (%s) to %s' % (datetime.now(), len(scenes), dtype, out_dir))
+
+    tasks = [(paths, os.path.join(out_dir, name), dtype) for name, paths in scenes.items()]
+    pool = multiprocessing.Pool(num_proc)
+    for _ in tqdm(pool.imap_unordered(chunk_scene, tasks), total=len(tasks)):
+        pass
+    pool.close()
+    pool.join()
+
+    # written last, marks the layout as complete
+    with open(os.path.join(out_dir, 'index.txt'), 'w') as f:
+        f.write('\n'.join(scenes.keys()))
+    print('%s: done' % datetime.now())
+
+def compact_label(file_path):
+    with np.load(file_path) as data:
+        if data['y'].ndim != 2 or data['y'].shape[1] == 1:
+            return
+        d = {k: data[k] for k in data.files}
+    # the history is dropped only if label_history rebuilds it
+    scene, t = param_key(file_path)
+    root = os.path.dirname(os.path.dirname(file_path))
+    if not np.allclose(label_history(root, scene, t, d['y'].shape[1]), d['y']):
+        raise Exception("[!] %s: label history doesn't match n.npz" % file_path)
+    d['y'] = current_label(d['y'])
+    tmp_path = file_path[:-4] + '_tmp.npz'
+    np.savez_compressed(tmp_path, **d)
+    os.replace(tmp_path, file_path)
+
+def compact_labels(root, data_type, num_proc):
+    # drop the label histories of an existing ae dataset in place after
+    # checking that label_history rebuilds them from n.npz
+    paths = scan(root, data_type)
+    print('%s: compact labels of %d samples' % (datetime.now(), len(paths)))
+    pool = multiprocessing.Pool(num_proc)
+    for _ in tqdm(pool.imap_unordered(compact_label, paths, chunksize=16), total=len(paths)):
+        pass
+    pool.close()
+    pool.join()
+    print('%s: done' % datetime.now())
+
+def code_dir(root, z_num):
+    # latent codes of an ae model, one <scene>.npz shard per scene with codes c
+    # [num_frames, z_num] and parameter changes p [num_frames-1, dof]. index.txt
+    # lists encoded scenes with the checkpoint, appended after each shard
+    return os.path.join(root, 'code%d' % z_num)
+
+def read_code_index(path):
+    index = OrderedDict()
+    index_path = os.path.join(path, 'index.txt')
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            for line in f.read().splitlines():
+                scene, ckpt = line.split(' ', 1)
+                # re-encoded scenes move to the end, the last is the newest
+                index.pop(scene, None)
+                index[scene] = ckpt
+    return index
+
+def write_code_shard(path, scene, ckpt, c, p):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    np.savez(os.path.join(path, '%s.npz' % scene), c=c, p=p)
+    with open(os.path.join(path, 'index.txt'), 'a') as f:
+        f.write('%s %s\n' % (scene, ckpt))
+
+def partial_stats(paths):
+    # per-channel min/max, sums for mean/std and the largest magnitude
+    stats = None
+    for file_path in paths:
+        with np.load(file_path) as data:
+            x = decode(data).astype(np.float64)
+        x = x.reshape(-1, x.shape[-1])
+        part = {
+            'n': x.shape[0],
+            'min': x.min(axis=0),
+            'max': x.max(axis=0),
+            'sum': x.sum(axis=0),
+            'sumsq': np.square(x).sum(axis=0),
+            'mag_max': np.sqrt(np.square(x).sum(axis=-1)).max(),
+        }
+        stats = part if stats is None else merge_stats(stats, part)
+    return stats
+
+def merge_stats(a, b):
+    return {
+        'n': a['n'] + b['n'],
+        'min': np.minimum(a['min'], b['min']),
+        'max': np.maximum(a['max'], b['max']),
+        'sum': a['sum'] + b['sum'],
+        'sumsq': a['sumsq'] + b['sumsq'],
+        'mag_max': max(a['mag_max'], b['mag_max']),
+    }
+
+def partial_hist(task):
+    # magnitude histogram on fixed bins, so that shards can be summed up
+    paths, mag_max, num_bins = task
+    hist = np.zeros(num_bins, dtype=np.int64)
+    for file_path in paths:
+        with np.load(file_path) as data:
+            x = decode(data).astype(np.float64)
+        mag = np.sqrt(np.square(x).sum(axis=-1))
+        hist += np.histogram(mag, bins=num_bins, range=(0, mag_max))[0]
+    return hist
+
+def stats(root, data_type, num_proc, num_bins=10000, write_range=False):
+    paths = scan(root, data_type)
+    shard_size = max(len(paths) // (num_proc*4), 1)
+    shards = [paths[i:i+shard_size] for i in range(0, len(paths), shard_size)]
+    print('%s: stats of %d samples with %d processes' % (datetime.now(), len(paths), num_proc))
+
+    pool = multiprocessing.Pool(num_proc)
+    s = None
+    for part in tqdm(pool.imap_unordered(partial_stats, shards), total=len(shards)):
+        s = part if s is None else merge_stats(s, part)
+
+    hist = np.zeros(num_bins, dtype=np.int64)
+    tasks = [(shard, s['mag_max'], num_bins) for shard in shards]
+    for part in tqdm(pool.imap_unordered(partial_hist, tasks), total=len(tasks)):
+        hist += part
+    pool.close()
+    pool.join()
+
+    mean = s['sum'] / s['n']
+    std = np.sqrt(np.maximum(s['sumsq'] / s['n'] - np.square(mean), 0))
+    percentiles = [50, 90, 99, 99.9]
+    cdf = np.cumsum(hist) / float(hist.sum())
+    bin_size = s['mag_max'] / num_bins
+    mag_p = [(np.searchsorted(cdf, q/100.0)+1)*bin_size for q in percentiles]
+
+    def fmt(v):
+        return ' '.join(['%g' % vi for vi in np.atleast_1d(v)])
+
+    stats_path = os.path.join(root, data_type[0]+'_stats.txt')
+    with open(stats_path, 'w') as f:
+        f.write('num_samples: %d\n' % len(paths))
+        f.write('min: %s\n' % fmt(s['min']))
+        f.write('max: %s\n' % fmt(s['max']))
+        f.write('mean: %s\n' % fmt(mean))
+        f.write('std: %s\n' % fmt(std))
+        for q, m in zip(percentiles, mag_p):
+            f.write('magnitude_p%g: %g\n' % (q, m))
+        f.write('magnitude_max: %g\n' % s['mag_max'])
+    np.savez(os.path.join(root, data_type[0]+'_stats.npz'),
+             hist=hist, mag_max=s['mag_max'], **{k: v for k, v in s.items() if k != 'mag_max'})
+    print('%s: stats written to %s' % (datetime.now(), stats_path))
+
+    if write_range:
+        # same format as the scene scripts
+        range_path = os.path.join(root, data_type[0]+'_range.txt')
+        with open(range_path, 'w') as f:
+            f.write('%.3f\n' % s['min'].min())
+            f.write('%.3f' % s['max'].max())
+        print('%s: range written to %s' % (datetime.now(), range_path))
+
+def codec_report(root, data_type, num_samples=100):
+    # error and size of each codec on random samples, relative to the range
+    # that training normalizes by
+    paths = scan(root, data_type)
+    x_range = read_range(root, data_type)
+    rng = np.random.RandomState(0)
+    paths = [paths[i] for i in rng.choice(len(paths), min(num_samples, len(paths)), replace=False)]
+
+    report = {c: [0, 0.0, 0.0] for c in codecs} # bytes, max error, sum of squared rmse
+    for file_path in tqdm(paths):
+        with np.load(file_path) as data:
+            x = decode(data)
+        for c in codecs:
+            f = io.BytesIO()
+            np.savez_compressed(f, **encode(x, c))
+            e_max, e_rms = error(x, c)
+            report[c][0] += f.tell()
+            report[c][1] = max(report[c][1], e_max)
+            report[c][2] += e_rms**2
+
+    report_path = os.path.join(root, data_type[0]+'_codec.txt')
+    with open(report_path, 'w') as f:
+        for c in codecs:
+            size, e_max, e_sq = report[c]
+            line = '%s: %.3f MB/sample, ratio %.3f, max error %g, rmse %g (range %g)' % (
+                c, size / len(paths) / 2**20, size / float(report['none'][0]),
+                e_max / x_range, np.sqrt(e_sq / len(paths)) / x_range, x_range)
+            print(line)
+            f.write(line + '\n')
+    print('%s: codec report written to %s' % (datetime.now(), report_path))
+
+def quantize_file(task):
+    file_path, out_path, codec = task
+    with np.load(file_path) as data:
+        x = decode(data)
+        y = data['y']
+    np.savez_compressed(out_path, y=y, **encode(x, codec))
+
+def quantize(root, data_type, codec, num_proc):
+    # re-encode a dataset into <dataset>_<codec>, other files are copied
+    out_root = root.rstrip('/\\') + '_' + codec
+    paths = scan(root, data_type)
+    os.makedirs(os.path.join(out_root, data_type[0]), exist_ok=True)
+    for n in os.listdir(root):
+        if os.path.isfile(os.path.join(root, n)):
+            shutil.copy(os.path.join(root, n), out_root)
+
+    args = read_args(out_root)
+    args['codec'] = codec
+    with open(os.path.join(out_root, 'args.txt'), 'w') as f:
+        for k, v in args.items():
+            f.write('%s: %s\n' % (k, v))
+
+    print('%s: quantize %d samples (%s) to %s' % (datetime.now(), len(paths), codec, out_root))
+    tasks = [(p, os.path.join(out_root, data_type[0], os.path.basename(p)), codec) for p in paths]
+    pool = multiprocessing.Pool(num_proc)
+    for _ in tqdm(pool.imap_unordered(quantize_file, tasks, chunksize=16), total=len(tasks)):
+        pass
+    pool.close()
+    pool.join()
+    print('%s: done' % datetime.now())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', type=str, default='pack', choices=['pack', 'manifest', 'stats', 'codec', 'quantize', 'chunk', 'label'])
+    parser.add_argument('--data_dir', type=str, default='data')
+    parser.add_argument('--dataset', type=str, default='smoke_pos21_size5_f200')
+    parser.add_argument('--data_type', type=str, default='velocity')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float16'])
+    parser.add_argument('--codec', type=str, default='f16', choices=codecs)
+    parser.add_argument('--num_samples', type=int, default=100, help='samples for the codec report')
+    parser.add_argument('--num_proc', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--jaco', action='store_true',
+                        help='also pack velocity jacobians, for --precomputed_jaco')
+    parser.add_argument('--write_range', action='store_true',
+                        help='overwrite v_range.txt with the min/max from stats')
+    args = parser.parse_args()
+
+    root = os.path.join(args.data_dir, args.dataset)
+    if args.mode == 'pack':
+        pack(root, args.data_type, args.dtype, jaco=args.jaco)
+    elif args.mode == 'manifest':
+        write_manifest(root, args.data_type)
+    elif args.mode == 'stats':
+        stats(root, args.data_type, args.num_proc, write_range=args.write_range)
+    elif args.mode == 'codec':
+        codec_report(root, args.data_type, args.num_samples)
+    elif args.mode == 'quantize':
+        quantize(root, args.data_type, args.codec, args.num_proc)
+    elif args.mode == 'chunk':
+        chunk(root, args.data_type, args.dtype, args.num_proc)
+    elif args.mode == 'label':
+        compact_labels(root, args.data_type, args.num_proc)
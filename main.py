@@ -6,8 +6,9 @@ from util import prepare_dirs_and_logger, save_config
 
 from trainer import Trainer
 from trainer3 import Trainer3
+from replicas import launch
 
-def main(config):
+def main(config, allreduce=None):
     prepare_dirs_and_logger(config)
     tf.set_random_seed(config.random_seed)
 
@@ -18,12 +19,12 @@ def main(config):
     batch_manager = BatchManager(config)
 
     if config.is_3d:
-        trainer = Trainer3(config, batch_manager)
+        trainer = Trainer3(config, batch_manager, allreduce)
     else:
-        trainer = Trainer(config, batch_manager)
+        trainer = Trainer(config, batch_manager, allreduce)
 
     if config.is_train:
-        save_config(config)
+        if trainer.is_chief: save_config(config)
         trainer.train()
     else:
         if not config.load_path:
@@ -32,4 +33,9 @@ def main(config):
 
 if __name__ == "__main__":
     config, unparsed = get_config()
-    main(config)
+    if config.is_train and config.num_replicas > 1:
+        # one model dir for all replicas
+        prepare_dirs_and_logger(config)
+        launch(main, config)
+    else:
+        main(config)
@@ -3,8 +3,10 @@ import tensorflow as tf
 from ops import *
 
 def GeneratorBE(z, filters, output_shape, name='G',
-                num_conv=4, conv_k=3, last_k=3, repeat=0, skip_concat=False, act=lrelu, reuse=False):
-    with tf.variable_scope(name, reuse=reuse) as vs:
+                num_conv=4, conv_k=3, last_k=3, repeat=0, skip_concat=False, act=lrelu, reuse=False,
+                dtype=tf.float32):
+    # dtype: of the conv stack, float16/bfloat16 for mixed precision (see master_getter)
+    with tf.variable_scope(name, reuse=reuse, custom_getter=master_getter) as vs:
         if repeat == 0:
             repeat_num = int(np.log2(np.max(output_shape[:-1]))) - 2
         else:
@@ -16,7 +18,7 @@ def GeneratorBE(z, filters, output_shape, name='G',
 
         num_output = int(np.prod(x0_shape))
         layer_num = 0
-        x = linear(z, num_output, name=str(layer_num)+'_fc')
+        x = linear(tf.cast(z, dtype), num_output, name=str(layer_num)+'_fc')
         layer_num += 1
         x = reshape(x, x0_shape[0], x0_shape[1], x0_shape[2])
         x0 = x
@@ -39,15 +41,34 @@ def GeneratorBE(z, filters, output_shape, name='G',
             elif not skip_concat:
                 x += x0
         
+        # the output layer runs in float32, curl and jacobian take differences of it
+        x = tf.cast(x, tf.float32)
         out = conv2d(x, output_shape[-1], k=last_k, s=1, name=str(layer_num)+'_conv')
         # out = tf.clip_by_value(out, -1, 1)
 
     variables = tf.contrib.framework.get_variables(vs)
     return out, variables
 
+def conv_block3(x, filters, num_conv, conv_k, act, layer_num, recompute='none'):
+    # num_conv convolutions named from layer_num on. recompute='conv' keeps the
+    # input of every convolution for the backward pass (its bias and activation
+    # outputs are recomputed), which needs resource variables
+    def conv(x, i):
+        return conv3d(x, filters, k=conv_k, s=1, act=act, name=str(layer_num+i)+'_conv')
+
+    for i in range(num_conv):
+        if recompute == 'conv':
+            x = tf.contrib.layers.recompute_grad(lambda x, i=i: conv(x, i))(x)
+        else:
+            x = conv(x, i)
+    return x
+
 def GeneratorBE3(z, filters, output_shape, name='G',
-                num_conv=4, conv_k=3, last_k=3, repeat=0, skip_concat=False, act=lrelu, reuse=False):
-    with tf.variable_scope(name, reuse=reuse) as vs:
+                num_conv=4, conv_k=3, last_k=3, repeat=0, skip_concat=False, act=lrelu, reuse=False,
+                crop=None, recompute='none', dtype=tf.float32):
+    # crop: ([b,3] offsets, [z,y,x] size) of aligned sub-volumes to generate
+    # instead of the whole output_shape domain, with the same variables
+    with tf.variable_scope(name, reuse=reuse, custom_getter=master_getter) as vs:
         if repeat == 0:
             repeat_num = int(np.log2(np.max(output_shape[:-1]))) - 2
         else:
@@ -58,15 +79,21 @@ def GeneratorBE3(z, filters, output_shape, name='G',
 
         num_output = int(np.prod(x0_shape))
         layer_num = 0
-        x = linear(z, num_output, name=str(layer_num)+'_fc')
+        x = linear(tf.cast(z, dtype), num_output, name=str(layer_num)+'_fc')
         layer_num += 1
         x = tf.reshape(x, [-1] + x0_shape)
+        if crop is not None:
+            offset, size = crop
+            s = np.power(2, repeat_num-1)
+            assert(np.sum([i % s for i in size]) == 0)
+            offset = tf.concat([offset // s, tf.zeros_like(offset[:,:1])], axis=-1)
+            size = [i // s for i in size] + [-1]
+            x = tf.stack([tf.slice(x[i], offset[i], size) for i in range(get_conv_shape(x)[0])])
         x0 = x
         
         for idx in range(repeat_num):
-            for _ in range(num_conv):
-                x = conv3d(x, filters, k=conv_k, s=1, act=act, name=str(layer_num)+'_conv')
-                layer_num += 1
+            x = conv_block3(x, filters, num_conv, conv_k, act, layer_num, recompute)
+            layer_num += num_conv
 
             if idx < repeat_num - 1:
                 if skip_concat:
@@ -81,20 +108,22 @@ def GeneratorBE3(z, filters, output_shape, name='G',
             elif not skip_concat:
                 x += x0
 
+        x = tf.cast(x, tf.float32)
         out = conv3d(x, output_shape[-1], k=last_k, s=1, name=str(layer_num)+'_conv')
 
     variables = tf.contrib.framework.get_variables(vs)
     return out, variables
 
-def DiscriminatorPatch(x, filters, name='D', train=True, reuse=False):
-    with tf.variable_scope(name, reuse=reuse) as vs:
+def DiscriminatorPatch(x, filters, name='D', train=True, reuse=False, dtype=tf.float32):
+    with tf.variable_scope(name, reuse=reuse, custom_getter=master_getter) as vs:
+        x = tf.cast(x, dtype)
         repeat_num = 3 # if c4k3s2, rfs 95, w/16=8, if c3k3s2, rfs 47, w/8=16
         d = int(filters/2)
         for _ in range(repeat_num): 
             x = conv2d(x, d, k=3, act=lrelu) # 64/32/16-64/128/256
             d *= 2
         x = conv2d(x, d, k=3, s=1, act=lrelu) # 16x16x512
-        out = conv2d(x, 1, k=3, s=1) # 16x16x1
+        out = tf.cast(conv2d(x, 1, k=3, s=1), tf.float32) # 16x16x1
 
         # x = conv2d(x, int(d/2), k=3, s=2, act=lrelu) # 8x8x256
         # b = get_conv_shape(x)[0]
@@ -102,21 +131,23 @@ def DiscriminatorPatch(x, filters, name='D', train=True, reuse=False):
     variables = tf.contrib.framework.get_variables(vs)    
     return out, variables
 
-def DiscriminatorPatch3(x, filters, name='D', train=True, reuse=False):
-    with tf.variable_scope(name, reuse=reuse) as vs:
+def DiscriminatorPatch3(x, filters, name='D', train=True, reuse=False, dtype=tf.float32):
+    with tf.variable_scope(name, reuse=reuse, custom_getter=master_getter) as vs:
+        x = tf.cast(x, dtype)
         repeat_num = 3 # if c4k3s2, rfs 95, w/16=8, if c3k3s2, rfs 47, w/8=16
         d = int(filters/2)
         for _ in range(repeat_num): 
             x = conv3d(x, d, k=3, act=lrelu) # 64/32/16-64/128/256
             d *= 2
         x = conv3d(x, d, k=3, s=1, act=lrelu) # 16x16x512
-        out = conv3d(x, 1, k=3, s=1) # 16x16x1
+        out = tf.cast(conv3d(x, 1, k=3, s=1), tf.float32) # 16x16x1
 
     variables = tf.contrib.framework.get_variables(vs)    
     return out, variables
 
-def EncoderBE(x, filters, z_num, name='enc', num_conv=4, conv_k=3, repeat=0, act=lrelu, reuse=False):
-    with tf.variable_scope(name, reuse=reuse) as vs:
+def EncoderBE(x, filters, z_num, name='enc', num_conv=4, conv_k=3, repeat=0, act=lrelu, reuse=False,
+              dtype=tf.float32):
+    with tf.variable_scope(name, reuse=reuse, custom_getter=master_getter) as vs:
         x_shape = get_conv_shape(x)[1:]
         if repeat == 0:
             repeat_num = int(np.log2(np.max(x_shape[:-1]))) - 2
@@ -126,6 +157,7 @@ def EncoderBE(x, filters, z_num, name='enc', num_conv=4, conv_k=3, repeat=0, act
         
         ch = filters
         layer_num = 0
+        x = tf.cast(x, dtype)
         x = conv2d(x, ch, k=conv_k, s=1, act=act, name=str(layer_num)+'_conv')
         x0 = x
         layer_num += 1
@@ -146,13 +178,14 @@ def EncoderBE(x, filters, z_num, name='enc', num_conv=4, conv_k=3, repeat=0, act
 
         b = get_conv_shape(x)[0]
         flat = tf.reshape(x, [b, -1])
-        out = linear(flat, z_num, name=str(layer_num)+'_fc')
+        out = tf.cast(linear(flat, z_num, name=str(layer_num)+'_fc'), tf.float32)
 
     variables = tf.contrib.framework.get_variables(vs)
     return out, variables
 
-def EncoderBE3(x, filters, z_num, name='enc', num_conv=3, conv_k=3, repeat=0, act=lrelu, reuse=False):
-    with tf.variable_scope(name, reuse=reuse) as vs:
+def EncoderBE3(x, filters, z_num, name='enc', num_conv=3, conv_k=3, repeat=0, act=lrelu, reuse=False,
+               recompute='none', dtype=tf.float32):
+    with tf.variable_scope(name, reuse=reuse, custom_getter=master_getter) as vs:
         x_shape = get_conv_shape(x)[1:]
         if repeat == 0:
             repeat_num = int(np.log2(np.max(x_shape[:-1]))) - 2
@@ -162,13 +195,13 @@ def EncoderBE3(x, filters, z_num, name='enc', num_conv=3, conv_k=3, repeat=0, ac
         
         ch = filters
         layer_num = 0
+        x = tf.cast(x, dtype)
         x = conv3d(x, ch, k=conv_k, s=1, act=act, name=str(layer_num)+'_conv')
         x0 = x
         layer_num += 1
         for idx in range(repeat_num):
-            for _ in range(num_conv):
-                x = conv3d(x, filters, k=conv_k, s=1, act=act, name=str(layer_num)+'_conv')
-                layer_num += 1
+            x = conv_block3(x, filters, num_conv, conv_k, act, layer_num, recompute)
+            layer_num += num_conv
 
             # skip connection
             x = tf.concat([x, x0], axis=-1)
@@ -182,35 +215,37 @@ def EncoderBE3(x, filters, z_num, name='enc', num_conv=3, conv_k=3, repeat=0, ac
 
         b = get_conv_shape(x)[0]
         flat = tf.reshape(x, [b, -1])
-        out = linear(flat, z_num, name=str(layer_num)+'_fc')
+        out = tf.cast(linear(flat, z_num, name=str(layer_num)+'_fc'), tf.float32)
 
     variables = tf.contrib.framework.get_variables(vs)
     return out, variables
 
 def AE(x, filters, z_num, name='AE', num_conv=4, conv_k=3, last_k=3, repeat=0,
-                    act=lrelu, skip_concat=False, use_sparse=False, reuse=False):
+                    act=lrelu, skip_concat=False, use_sparse=False, reuse=False, dtype=tf.float32):
     with tf.variable_scope(name, reuse=reuse) as vs:
         z, _ = EncoderBE(x, filters, z_num, 'enc',
                          num_conv=num_conv-1, conv_k=conv_k, repeat=repeat,
-                         act=act, reuse=reuse)
+                         act=act, reuse=reuse, dtype=dtype)
         if use_sparse: z = tf.sigmoid(z)
         out, _ = GeneratorBE(z, filters, get_conv_shape(x)[1:], 'dec',
                              num_conv=num_conv, conv_k=conv_k, last_k=last_k, repeat=repeat,
-                             skip_concat=skip_concat, act=act, reuse=reuse)
+                             skip_concat=skip_concat, act=act, reuse=reuse, dtype=dtype)
 
     variables = tf.contrib.framework.get_variables(vs)
     return out, z, variables
 
 def AE3(x, filters, z_num, name='AE', num_conv=4, conv_k=3, last_k=3, repeat=0,
-                    act=lrelu, skip_concat=False, use_sparse=False, reuse=False):
+                    act=lrelu, skip_concat=False, use_sparse=False, reuse=False, recompute='none',
+                    dtype=tf.float32):
     with tf.variable_scope(name, reuse=reuse) as vs:
         z, _ = EncoderBE3(x, filters, z_num, 'enc',
                          num_conv=num_conv-1, conv_k=conv_k, repeat=repeat,
-                         act=act, reuse=reuse)
+                         act=act, reuse=reuse, recompute=recompute, dtype=dtype)
         if use_sparse: z = tf.sigmoid(z)
         out, _ = GeneratorBE3(z, filters, get_conv_shape(x)[1:], 'dec',
                              num_conv=num_conv, conv_k=conv_k, last_k=last_k, repeat=repeat,
-                             skip_concat=skip_concat, act=act, reuse=reuse)
+                             skip_concat=skip_concat, act=act, reuse=reuse, recompute=recompute,
+                             dtype=dtype)
 
     variables = tf.contrib.framework.get_variables(vs)
     return out, z, variables
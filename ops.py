@@ -90,6 +90,15 @@ def upscale3(x, scale):
     dh = tf.image.resize_nearest_neighbor(dh, (d,h))
     return tf.reshape(dh, [b,d,h,w,c])
 
+def master_getter(getter, *args, **kwargs):
+    # custom getter of mixed precision models: variables are kept (and updated)
+    # in float32 and cast to the half dtype of the layer that reads them
+    dtype = kwargs.get('dtype', None)
+    if dtype in [tf.float16, tf.bfloat16]:
+        kwargs['dtype'] = tf.float32
+        return tf.cast(getter(*args, **kwargs), dtype)
+    return getter(*args, **kwargs)
+
 def var_on_cpu(name, shape, initializer, dtype=tf.float32):
     return slim.model_variable(name, shape, dtype=dtype, initializer=initializer, device='/CPU:0')
 
@@ -264,6 +273,12 @@ def jacobian3(x):
 
     return j, c
 
+def vort_from_jaco(j):
+    # vorticity (curl in 3d) from the channels of jacobian / jacobian3
+    if int_shape(j)[-1] == 4:
+        return tf.expand_dims(j[...,2] - j[...,1], axis=-1)
+    return tf.stack([j[...,7] - j[...,5], j[...,2] - j[...,6], j[...,3] - j[...,1]], axis=-1)
+
 def curl(x, data_format='NHWC'):
 
     print('x.shape')
@@ -352,24 +367,45 @@ def grad_np(x):
     v = np.concatenate([v,np.expand_dims(v[:,-1,:], axis=1)], axis=1)
     return np.stack([u,v], axis=-1)
 
+def vort_from_jaco_np(j):
+    if j.shape[-1] == 4:
+        return np.expand_dims(j[...,2] - j[...,1], axis=-1)
+    return np.stack([j[...,7] - j[...,5], j[...,2] - j[...,6], j[...,3] - j[...,1]], axis=-1)
+
 def plane_view_np(x, xy_plane=True, project=True):
-    x_shape = x.shape # zyxd
-    c_id = [int(x_shape[0]/2), int(x_shape[2]/2)]
+    x_shape = x.shape # (b)zyxd
+    c_id = [int(x_shape[-4]/2), int(x_shape[-2]/2)]
 
     if xy_plane:
         if project:
-            x = np.mean(x, axis=0)
+            x = np.mean(x, axis=-4)
         else:
-            x = x[c_id[0],:,:,:]
+            x = x[...,c_id[0],:,:,:]
     else:
         if project:
-            x = np.mean(x, axis=2).transpose([1,0,2])
+            x = np.swapaxes(np.mean(x, axis=-2), -3, -2)
         else:
-            x = x[:,:,c_id[1],:].transpose([1,0,2])
+            x = np.swapaxes(x[...,c_id[1],:], -3, -2)
 
     x = np.clip((x+1)*127.5, 0, 255)
     return x
 
+def jacobian_np(x):
+    # numpy version of jacobian, x: byxd
+    dudx = x[:,:,1:,0] - x[:,:,:-1,0]
+    dudy = x[:,1:,:,0] - x[:,:-1,:,0]
+    dvdx = x[:,:,1:,1] - x[:,:,:-1,1]
+    dvdy = x[:,1:,:,1] - x[:,:-1,:,1]
+
+    dudx = np.concatenate([dudx,np.expand_dims(dudx[:,:,-1], axis=2)], axis=2)
+    dvdx = np.concatenate([dvdx,np.expand_dims(dvdx[:,:,-1], axis=2)], axis=2)
+    dudy = np.concatenate([dudy,np.expand_dims(dudy[:,-1,:], axis=1)], axis=1)
+    dvdy = np.concatenate([dvdy,np.expand_dims(dvdy[:,-1,:], axis=1)], axis=1)
+
+    j = np.stack([dudx,dudy,dvdx,dvdy], axis=-1)
+    w = np.expand_dims(dvdx - dudy, axis=-1)
+    return j, w
+
 def jacobian_np3(x):
     # x: bzyxd
     dudx = x[:,:,:,1:,0] - x[:,:,:,:-1,0]
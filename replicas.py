@@ -0,0 +1,115 @@
+import os
+import sys
+import time
+import tempfile
+import multiprocessing
+from datetime import datetime
+
+import numpy as np
+
+# synchronous data-parallel training with local processes, see --num_replicas:
+# every replica runs its own Trainer on a shard of the sample stream and the
+# gradients are averaged in shared memory before they are applied
+
+class AllReduce(object):
+    # mean of float32 vectors over the replicas. the buffer is a file in
+    # /dev/shm with a row per replica and one for the result, each replica
+    # reduces its segment of the rows (reduce-scatter) and reads the whole result
+    def __init__(self, num_replicas, ctx):
+        self.num_replicas = num_replicas
+        self.barrier = ctx.Barrier(num_replicas)
+        shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.path = os.path.join(shm_dir, 'allreduce_%d.npy' % os.getpid())
+        self.buf = None
+
+    def attach(self, replica, size):
+        # called by every replica once the graph (and with it the size) is known
+        self.replica = replica
+        if replica == 0:
+            np.lib.format.open_memmap(self.path, mode='w+', dtype=np.float32,
+                                      shape=(self.num_replicas+1, size))
+        self.barrier.wait()
+        self.buf = np.load(self.path, mmap_mode='r+')
+        self.barrier.wait()
+        if replica == 0:
+            os.remove(self.path) # stays mapped until the replicas exit
+
+        bounds = np.linspace(0, size, self.num_replicas+1).astype(np.int64)
+        self.segment = slice(bounds[replica], bounds[replica+1])
+
+    def mean(self, x):
+        n = x.size
+        self.buf[self.replica,:n] = x
+        self.barrier.wait()
+        s = self.segment
+        np.mean(self.buf[:self.num_replicas,s], axis=0, out=self.buf[-1,s])
+        self.barrier.wait()
+        # the rows are rewritten only after all replicas reached the next mean
+        return np.array(self.buf[-1,:n])
+
+    def broadcast(self, x):
+        # x of replica 0, through its row: the result row may still be read
+        n = x.size
+        if self.replica == 0:
+            self.buf[0,:n] = x
+        self.barrier.wait()
+        x = np.array(self.buf[0,:n])
+        self.barrier.wait()
+        return x
+
+def run_replica(main, config, replica, allreduce):
+    config.replica = replica
+    main(config, allreduce)
+
+def launch(main, config):
+    # main(config, allreduce) in num_replicas processes, stops all of them
+    # if one fails. tf doesn't survive a fork, so the processes are spawned
+    ctx = multiprocessing.get_context('spawn')
+    allreduce = AllReduce(config.num_replicas, ctx)
+    procs = [ctx.Process(target=run_replica, args=(main, config, r, allreduce))
+             for r in range(config.num_replicas)]
+    print('%s: start %d replicas' % (datetime.now(), len(procs)))
+    for p in procs:
+        p.start()
+
+    exitcode = 0
+    while procs:
+        for p in procs:
+            p.join(timeout=1)
+            if p.exitcode is None:
+                continue
+            procs.remove(p)
+            if p.exitcode != 0 and exitcode == 0:
+                print('%s: a replica failed (%d), stop all' % (datetime.now(), p.exitcode))
+                exitcode = p.exitcode
+                for q in procs:
+                    q.terminate()
+            break
+    if exitcode != 0:
+        sys.exit(exitcode)
+
+def bench_allreduce_worker(allreduce, replica, size, num_iter, times):
+    allreduce.attach(replica, size)
+    x = np.random.rand(size).astype(np.float32)
+    allreduce.mean(x)
+    t = time.time()
+    for _ in range(num_iter):
+        allreduce.mean(x)
+    times[replica] = (time.time() - t) / num_iter
+
+def bench_allreduce(size=10**7, num_iter=20):
+    # time of averaging size gradients per step over 1/2/4/8 processes
+    ctx = multiprocessing.get_context('spawn')
+    for n in [1, 2, 4, 8]:
+        allreduce = AllReduce(n, ctx)
+        times = ctx.RawArray('d', n)
+        procs = [ctx.Process(target=bench_allreduce_worker,
+                             args=(allreduce, r, size, num_iter, times)) for r in range(n)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        print('%d replicas: %.1f ms per mean of %d floats' % (n, max(times)*1000, size))
+
+if __name__ == '__main__':
+    bench_allreduce()
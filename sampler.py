@@ -0,0 +1,49 @@
+import numpy as np
+
+# sample id streams of the batch manager, without tensorflow (see tests)
+
+class EpochSampler(object):
+    # sample ids of a reproducible stream without replacement: epoch e is a
+    # permutation from RandomState([seed..., e]) with seed an int or a list
+    # of ints, worker w of k takes every k-th id.
+    # the stream position is derived from the step, so a run resumed with
+    # --start_step continues it (up to the samples that were queued)
+    def __init__(self, num_samples, seed, start=0, worker=0, num_workers=1):
+        self.num_samples = num_samples
+        self.seed = [int(s) for s in np.atleast_1d(seed)]
+        self.num_workers = num_workers
+        self.pos = start + (worker - start) % num_workers
+        self.epoch = -1
+        self.perm = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        epoch, i = divmod(self.pos, self.num_samples)
+        if epoch != self.epoch:
+            self.perm = np.random.RandomState(self.seed + [epoch]).permutation(self.num_samples)
+            self.epoch = epoch
+        self.pos += self.num_workers
+        return self.perm[i]
+
+class MixedSampler(object):
+    # global ids of concatenated datasets: the dataset of each draw is chosen
+    # by weight, ids within dataset i follow its own EpochSampler stream
+    # seeded with [seed, i], independent of the other datasets' epochs.
+    # choices before start are replayed to resume at the same position
+    def __init__(self, sizes, weights, seed, start=0, worker=0, num_workers=1):
+        self.offsets = np.cumsum([0] + list(sizes[:-1]))
+        self.p = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+        self.rng = np.random.RandomState([seed, worker])
+        num_drawn = len(range(worker, start, num_workers))
+        counts = np.bincount(self.rng.choice(len(sizes), num_drawn, p=self.p), minlength=len(sizes))
+        self.samplers = [EpochSampler(n, [seed, i], c*num_workers, worker, num_workers)
+                         for i, (n, c) in enumerate(zip(sizes, counts))]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        i = self.rng.choice(len(self.samplers), p=self.p)
+        return self.offsets[i] + next(self.samplers[i])
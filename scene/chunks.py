@@ -0,0 +1,64 @@
+import os
+import numpy as np
+
+# per-scene layout: <root>/<t>_scene/<scene>.npy holds the [num_frames, ...] frames
+# of a scene and <scene>_y.npy their labels, index.txt lists the scenes in order.
+# a scene is a frame file's parameter indices without the last (frame) one.
+
+def chunk_dir(root, data_type):
+    return os.path.join(root, data_type[0]+'_scene')
+
+def has_chunks(root, data_type):
+    # index.txt is written last
+    return os.path.exists(os.path.join(chunk_dir(root, data_type), 'index.txt'))
+
+def scene_name(key):
+    return '_'.join([str(k) for k in key]) or 'scene'
+
+class SceneChunks(object):
+    def __init__(self, root, data_type):
+        self.dir = chunk_dir(root, data_type)
+        with open(os.path.join(self.dir, 'index.txt'), 'r') as f:
+            self.scenes = f.read().split()
+
+    def open(self, scene):
+        # memory-mapped frames and labels of a scene, one open per scene
+        if not isinstance(scene, str):
+            scene = scene_name(scene)
+        x = np.load(os.path.join(self.dir, scene+'.npy'), mmap_mode='r')
+        y = np.load(os.path.join(self.dir, scene+'_y.npy'), mmap_mode='r')
+        return x, y
+
+    def frames(self, scene, t0=0, t1=None):
+        x, y = self.open(scene)
+        return np.array(x[t0:t1], dtype=np.float32), np.array(y[t0:t1])
+
+    def frame(self, scene, t):
+        x, y = self.open(scene)
+        return np.array(x[t], dtype=np.float32), np.array(y[t])
+
+    def scene(self, scene):
+        return self.frames(scene)
+
+class Frame(dict):
+    # same use as a loaded npz file
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+class FrameReader(object):
+    # frames of one scene, from its chunk if the dataset has been chunked,
+    # otherwise from the per-frame files
+    def __init__(self, root, path_format, key, data_type='velocity'):
+        self.path_format = os.path.join(root, data_type[0], path_format)
+        self.key = tuple(key)
+        self.x = None
+        if has_chunks(root, data_type):
+            self.x, self.y = SceneChunks(root, data_type).open(self.key)
+
+    def load(self, t):
+        if self.x is None:
+            return np.load(self.path_format % (self.key + (t,)))
+        return Frame(x=np.array(self.x[t], dtype=np.float32), y=np.array(self.y[t]))
@@ -0,0 +1,35 @@
+import numpy as np
+
+# on-disk storage of a frame
+# none: float32, f16: float16, i16/i8: per-frame scaled integers, x = xq*s
+codecs = ['none', 'f16', 'i16', 'i8']
+int_types = {'i16': np.int16, 'i8': np.int8}
+
+def encode(x, codec='none'):
+    # returns the savez keywords of a frame
+    if codec == 'none':
+        return {'x': x}
+    elif codec == 'f16':
+        return {'x': x.astype(np.float16)}
+    elif codec in int_types:
+        q_max = np.iinfo(int_types[codec]).max
+        s = max(float(np.abs(x).max()), 1e-8) / q_max
+        xq = np.clip(np.round(x / s), -q_max, q_max).astype(int_types[codec])
+        return {'x': xq, 's': np.float32(s)}
+    else:
+        raise Exception("[!] Unknown codec %s" % codec)
+
+def decode(data):
+    # data: loaded npz or a dict from encode
+    x = data['x']
+    if x.dtype != np.float32:
+        x = x.astype(np.float32)
+    if 's' in data:
+        x *= data['s']
+    return x
+
+def error(x, codec):
+    # reconstruction error of a codec on a frame
+    x = np.asarray(x, dtype=np.float32)
+    d = decode(encode(x, codec)) - x
+    return np.abs(d).max(), np.sqrt(np.mean(np.square(d)))
@@ -5,6 +5,8 @@ from tqdm import trange
 import numpy as np
 from PIL import Image
 import gc
+from codec import codecs, encode, decode
+from chunks import FrameReader
 try:
 	from manta import *
 except ImportError:
@@ -42,6 +44,7 @@ parser.add_argument("--min_particles", type=int, default=3)
 parser.add_argument("--bWidth", type=int, default=1)
 parser.add_argument("--open_bound", type=bool, default=False)
 parser.add_argument("--time_step", type=float, default=0.8)
+parser.add_argument("--codec", type=str, default='none', choices=codecs)
 
 args = parser.parse_args()
 
@@ -60,7 +63,6 @@ def advect():
     # p1, p2 = 2, 4
     p1, p2 = 0, 0
     p1_, p2_ = get_param(p1, p2)
-    v_path = os.path.join(args.log_dir, 'v')
     img_dir = os.path.join(args.log_dir, 'l_adv')
     if not os.path.exists(img_dir):
         os.makedirs(img_dir)        
@@ -122,10 +124,10 @@ def advect():
         gui.pause()
 
     l_ = np.zeros([res_z,res_y,res_x], dtype=np.float32)
+    frames = FrameReader(args.log_dir, args.path_format, (p1, p2))
     for t in trange(args.num_frames):
-        v_path_ = os.path.join(v_path, args.path_format % (p1, p2, t))
-        with np.load(v_path_) as data:
-            v = data['x']
+        with frames.load(t) as data:
+            v = decode(data)
 
         copyArrayToGridMAC(v, vel)
 
@@ -353,9 +355,9 @@ def main():
             pit = tuple(pi_list[i].tolist() + [t])
 
             v_file_path = os.path.join(args.log_dir, 'v', args.path_format % pit)
-            np.savez_compressed(v_file_path, 
-                                x=v_,
-                                y=param_)
+            np.savez_compressed(v_file_path,
+                                y=param_,
+                                **encode(v_, args.codec))
 
             # # save particles
             # pt_file_path = os.path.join(args.log_dir, 'pt', '%d_%d_%d.uni' % pit)
@@ -5,6 +5,8 @@ from tqdm import trange
 import numpy as np
 from PIL import Image
 import gc
+from codec import codecs, encode, decode
+from chunks import FrameReader
 try:
 	from manta import *
 except ImportError:
@@ -41,6 +43,7 @@ parser.add_argument("--min_particles", type=int, default=2)
 parser.add_argument("--bWidth", type=int, default=1)
 parser.add_argument("--open_bound", type=bool, default=False)
 parser.add_argument("--time_step", type=float, default=0.5)
+parser.add_argument("--codec", type=str, default='none', choices=codecs)
 
 args = parser.parse_args()
 
@@ -59,7 +62,6 @@ def advect():
 	# p1, p2 = 4, 1
 	p1, p2 = 0, 0
 	p1_, p2_ = get_param(p1, p2)
-	v_path = os.path.join(args.log_dir, 'v')
 	img_dir = os.path.join(args.log_dir, 'l_adv')
 	if not os.path.exists(img_dir):
 		os.makedirs(img_dir)
@@ -106,10 +108,10 @@ def advect():
 		gui.pause()
 
 	l_ = np.zeros([res_y,res_x], dtype=np.float32)
+	frames = FrameReader(args.log_dir, args.path_format, (p1, p2))
 	for t in trange(args.num_frames):
-		v_path_ = os.path.join(v_path, args.path_format % (p1, p2, t))
-		with np.load(v_path_) as data:
-			v = data['x']
+		with frames.load(t) as data:
+			v = decode(data)
 			v = np.dstack((v,np.zeros([res_y, res_x, 1])))
 
 		copyArrayToGridMAC(v, vel)
@@ -310,9 +312,9 @@ def main():
 			pit = tuple(pi_list[i].tolist() + [t])
 
 			v_file_path = os.path.join(args.log_dir, 'v', args.path_format % pit)
-			np.savez_compressed(v_file_path, 
-								x=v_[...,:2],
-								y=param_)
+			np.savez_compressed(v_file_path,
+								y=param_,
+								**encode(v_[...,:2], args.codec))
 
 			s.step()
 		gc.collect()
@@ -12,6 +12,8 @@ except ImportError:
 
 from collections import deque
 from perlin import TileableNoise
+from codec import codecs, encode, decode
+from chunks import FrameReader
 
 parser = argparse.ArgumentParser()
 
@@ -44,6 +46,7 @@ parser.add_argument("--buoyancy", type=float, default=-4e-3)
 parser.add_argument("--bWidth", type=int, default=1)
 parser.add_argument("--open_bound", type=str, default='xXyYzZ') # xXyY
 parser.add_argument("--time_step", type=float, default=0.5)
+parser.add_argument("--codec", type=str, default='none', choices=codecs)
 parser.add_argument("--adv_order", type=int, default=2)
 parser.add_argument("--clamp_mode", type=int, default=2)
 
@@ -63,7 +66,6 @@ def advect():
 
 	p1 = 0
 	# p1_ = get_param(p1)
-	v_path = os.path.join(args.log_dir, 'v')
 	img_dir = os.path.join(args.log_dir, 'd_adv')
 	if not os.path.exists(img_dir):
 		os.makedirs(img_dir)
@@ -104,10 +106,10 @@ def advect():
 		d_ = np.zeros([res_z, res_y, res_x], dtype=np.float32)
 	else:
 		d_ = np.zeros([res_y, res_x], dtype=np.float32)
+	frames = FrameReader(args.log_dir, args.path_format, (p1,))
 	for t in trange(args.num_frames):
-		v_path_ = os.path.join(v_path, args.path_format % (p1, t))
-		with np.load(v_path_) as data:
-			v = data['x']
+		with frames.load(t) as data:
+			v = decode(data)
 			if res_z == 1:
 				v = np.dstack((v,np.zeros([res_y, res_x, 1])))
 			p = data['y']
@@ -257,12 +259,12 @@ def main():
 			px = (nx+1)*0.5 * (args.max_src_pos-args.min_src_pos) + args.min_src_pos # [minx, maxx]
 			pz = 0.5
 			nqx.append(px)
-			param_ = [list(nqx)]
+			param_ = [[px]] # history is kept once per scene in n.npz
 			if res_z > 1:
 				nz = noise.noise3(x=nx_, y=ny_, z=t*args.nscale, repeat=args.nrepeat)
 				pz = (nz+1)*0.5 * (args.max_src_pos-args.min_src_pos) + args.min_src_pos # [minx, maxx]
 				nqz.append(pz)
-				param_ = [list(nqx), list(nqz)]
+				param_ = [[px], [pz]]
 			param_ = np.array(param_)
 
 			source = s.create(Sphere, center=gs*vec3(px,args.src_y_pos,pz), radius=radius)
@@ -295,12 +297,12 @@ def main():
 			v_file_path = os.path.join(args.log_dir, 'v', args.path_format % (i, t))
 			if res_z > 1:
 				np.savez_compressed(v_file_path,
-									x=v_,
-									y=param_)
+									y=param_,
+									**encode(v_, args.codec))
 			else:
 				np.savez_compressed(v_file_path,
-									x=v_[...,:2],
-									y=param_)
+									y=param_,
+									**encode(v_[...,:2], args.codec))
 
 			# p_file_path = os.path.join(args.log_dir, 'p', args.path_format % (i, t))
 			# np.savez_compressed(p_file_path,
@@ -5,6 +5,8 @@ from tqdm import trange
 import numpy as np
 from PIL import Image
 import gc
+from codec import codecs, encode, decode
+from chunks import FrameReader
 try:
 	from manta import *
 except ImportError:
@@ -38,13 +40,13 @@ parser.add_argument("--buoyancy", type=float, default=-4e-3)
 parser.add_argument("--bWidth", type=int, default=1)
 parser.add_argument("--open_bound", type=str, default='xXyYzZ')
 parser.add_argument("--time_step", type=float, default=0.5)
+parser.add_argument("--codec", type=str, default='none', choices=codecs)
 parser.add_argument("--adv_order", type=int, default=2)
 parser.add_argument("--clamp_mode", type=int, default=2)
 
 args = parser.parse_args()
 
 def advect():
-	v_path = os.path.join(args.log_dir, 'v')
 	img_dir = os.path.join(args.log_dir, 'd_adv')
 	if not os.path.exists(img_dir):
 		os.makedirs(img_dir)
@@ -85,10 +87,10 @@ def advect():
 		d_ = np.zeros([res_z, res_y, res_x], dtype=np.float32)
 	else:
 		d_ = np.zeros([res_y, res_x], dtype=np.float32)
+	frames = FrameReader(args.log_dir, args.path_format, ())
 	for t in trange(args.num_frames):
-		v_path_ = os.path.join(v_path, args.path_format % t)
-		with np.load(v_path_) as data:
-			v = data['x']
+		with frames.load(t) as data:
+			v = decode(data)
 			if res_z == 1:
 				v = np.dstack((v,np.zeros([res_y, res_x, 1])))
 			p = data['y']
@@ -226,11 +228,11 @@ def main():
 		px = 0.5 + args.circle_radius*np.cos(t*2*np.pi/args.circle_period)
 		pz = 0.5
 		nqx.append(px)
-		param_ = [list(nqx)]
+		param_ = [[px]] # history is kept once per scene in n.npz
 		if res_z > 1:
 			pz = 0.5 + args.circle_radius*np.sin(t*2*np.pi/args.circle_period)
 			nqz.append(pz)
-			param_ = [list(nqx), list(nqz)]
+			param_ = [[px], [pz]]
 		
 		source = s.create(Sphere, center=gs*vec3(px,args.src_y_pos,pz), radius=radius)
 		source.applyToGrid(grid=density, value=1)
@@ -262,12 +264,12 @@ def main():
 		v_file_path = os.path.join(args.log_dir, 'v', args.path_format % t)
 		if res_z > 1:
 			np.savez_compressed(v_file_path,
-								x=v_,
-								y=param_)
+								y=param_,
+								**encode(v_, args.codec))
 		else:
 			np.savez_compressed(v_file_path,
-								x=v_[...,:2],
-								y=param_)
+								y=param_,
+								**encode(v_[...,:2], args.codec))
 
 		# p_file_path = os.path.join(args.log_dir, 'p', args.path_format % (i, t))
 		# np.savez_compressed(p_file_path,
@@ -5,6 +5,8 @@ from tqdm import trange
 import numpy as np
 from PIL import Image
 import gc
+from codec import codecs, encode, decode
+from chunks import FrameReader
 try:
 	from manta import *
 except ImportError:
@@ -37,6 +39,7 @@ parser.add_argument("--buoyancy", type=float, default=-4e-3)
 parser.add_argument("--bWidth", type=int, default=1)
 parser.add_argument("--open_bound", type=bool, default=False)
 parser.add_argument("--time_step", type=float, default=0.5)
+parser.add_argument("--codec", type=str, default='none', choices=codecs)
 parser.add_argument("--adv_order", type=int, default=2)
 parser.add_argument("--clamp_mode", type=int, default=2)
 
@@ -56,7 +59,6 @@ def advect():
 
 	p1, p2 = 10, 2
 	p1_, p2_ = get_param(p1, p2)
-	v_path = os.path.join(args.log_dir, 'v')
 	img_dir = os.path.join(args.log_dir, 'd_adv')
 	if not os.path.exists(img_dir):
 		os.makedirs(img_dir)
@@ -101,10 +103,10 @@ def advect():
 	print('PreNpRead')
 
 	d_ = np.zeros([res_y, res_x], dtype=np.float32)
+	frames = FrameReader(args.log_dir, args.path_format, (p1, p2))
 	for t in trange(args.num_frames):
-		v_path_ = os.path.join(v_path, args.path_format % (p1, p2, t))
-		with np.load(v_path_) as data:
-			v = data['x']
+		with frames.load(t) as data:
+			v = decode(data)
 			v = np.dstack((v,np.zeros([res_y, res_x, 1])))
 
 		print('NpRead')
@@ -234,8 +236,8 @@ def main():
 
 			v_file_path = os.path.join(args.log_dir, 'v', args.path_format % pit)
 			np.savez_compressed(v_file_path,
-								x=v_[...,:2],
-								y=param_)
+								y=param_,
+								**encode(v_[...,:2], args.codec))
 
 			# d_file_path = os.path.join(args.log_dir, 'd', args.path_format % pit)[:-3] + 'png'
 			# d_img = d_[::-1,:]*255
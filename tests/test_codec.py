@@ -0,0 +1,27 @@
+import io
+
+import numpy as np
+import pytest
+
+from scene.codec import codecs, encode, decode, error
+
+@pytest.mark.parametrize('codec', codecs)
+def test_round_trip(codec):
+    x = np.random.RandomState(0).randn(8, 16, 16, 3).astype(np.float32)
+    # through an npz file as the frames are stored
+    f = io.BytesIO()
+    np.savez(f, **encode(x, codec))
+    f.seek(0)
+    x_ = decode(np.load(f))
+    assert x_.dtype == np.float32 and x_.shape == x.shape
+
+    tol = {'none': 0, 'f16': 1e-3*np.abs(x).max(),
+           'i16': 0.5*np.abs(x).max()/32767, 'i8': 0.5*np.abs(x).max()/127}[codec]
+    # half a quantization step, up to float32 rounding of the scale
+    assert np.abs(x_ - x).max() <= tol*1.01
+    assert error(x, codec)[0] == np.abs(x_ - x).max()
+
+def test_zero_frame():
+    x = np.zeros((4, 4, 2), dtype=np.float32)
+    for codec in codecs:
+        assert not np.any(decode(encode(x, codec)))
@@ -0,0 +1,49 @@
+import os
+from collections import deque
+
+import numpy as np
+import pytest
+
+from data_tool import compact_label, label_history
+
+def write_scenes(root, num_scenes, num_frames):
+    # labels with the whole history per frame, as smoke3_mov wrote them
+    os.makedirs(os.path.join(root, 'v'))
+    rng = np.random.RandomState(0)
+    n = rng.rand(2, num_scenes, num_frames)
+    for i in range(num_scenes):
+        nqx = deque([-1]*num_frames, num_frames)
+        nqz = deque([-1]*num_frames, num_frames)
+        for t in range(num_frames):
+            nqx.append(n[0,i,t])
+            nqz.append(n[1,i,t])
+            np.savez_compressed(os.path.join(root, 'v', '%d_%d.npz' % (i, t)),
+                                x=np.zeros([2, 2, 2], dtype=np.float32), y=np.array([list(nqx), list(nqz)]))
+    np.savez_compressed(os.path.join(root, 'n.npz'), nx=n[0], nz=n[1])
+
+def test_label_history(tmpdir):
+    root = str(tmpdir)
+    write_scenes(root, 2, 5)
+    for i in range(2):
+        for t in range(5):
+            path = os.path.join(root, 'v', '%d_%d.npz' % (i, t))
+            with np.load(path) as data:
+                y = data['y']
+            np.testing.assert_allclose(label_history(root, i, t, 5), y)
+            compact_label(path)
+            with np.load(path) as data:
+                np.testing.assert_array_equal(data['y'], y[:, -1:])
+                assert data['x'].shape == (2, 2, 2)
+    # histories shorter than the scene keep the last frames
+    with np.load(os.path.join(root, 'n.npz')) as data:
+        np.testing.assert_allclose(label_history(root, 1, 4, 3), [data['nx'][1,2:], data['nz'][1,2:]])
+
+def test_compact_label_mismatch(tmpdir):
+    root = str(tmpdir)
+    write_scenes(root, 1, 3)
+    np.savez_compressed(os.path.join(root, 'n.npz'), nx=np.zeros([1, 3]), nz=np.zeros([1, 3]))
+    path = os.path.join(root, 'v', '0_2.npz')
+    with pytest.raises(Exception):
+        compact_label(path)
+    with np.load(path) as data:
+        assert data['y'].shape == (2, 3)
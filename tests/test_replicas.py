@@ -0,0 +1,30 @@
+import multiprocessing
+
+import numpy as np
+
+from replicas import AllReduce
+
+def replica(allreduce, r, results):
+    allreduce.attach(r, 10)
+    # vectors shorter than the buffer, twice to reuse the rows
+    for n in [7, 10]:
+        x = np.arange(n, dtype=np.float32) * (r + 1)
+        results.put((r, n, allreduce.mean(x), allreduce.broadcast(x)))
+
+def test_mean_and_broadcast():
+    ctx = multiprocessing.get_context('spawn')
+    num_replicas = 3
+    allreduce = AllReduce(num_replicas, ctx)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=replica, args=(allreduce, r, results))
+             for r in range(num_replicas)]
+    for p in procs:
+        p.start()
+    out = [results.get(timeout=60) for _ in range(2*num_replicas)]
+    for p in procs:
+        p.join(timeout=60)
+        assert p.exitcode == 0
+
+    for r, n, mean, x0 in out:
+        np.testing.assert_allclose(mean, np.arange(n) * 2)
+        np.testing.assert_array_equal(x0, np.arange(n))
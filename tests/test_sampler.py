@@ -0,0 +1,57 @@
+from sampler import EpochSampler, MixedSampler
+
+def take(sampler, num):
+    return [int(next(sampler)) for _ in range(num)]
+
+def test_epochs_are_permutations():
+    ids = take(EpochSampler(10, 3), 30)
+    for e in range(3):
+        assert sorted(ids[e*10:(e+1)*10]) == list(range(10))
+    assert ids[:10] != ids[10:20]
+
+def test_resume_position():
+    ids = take(EpochSampler(10, 3), 40)
+    for start in [0, 7, 10, 23]:
+        assert take(EpochSampler(10, 3, start), 12) == ids[start:start+12]
+
+def test_workers_are_disjoint():
+    ids = take(EpochSampler(10, 3), 40)
+    streams = [take(EpochSampler(10, 3, 0, w, 3), 10) for w in range(3)]
+    for w, stream in enumerate(streams):
+        assert stream == ids[w::3][:10]
+    # the workers split the first epoch (positions 0..9) without overlap
+    epoch = sum([s[:len(range(w, 10, 3))] for w, s in enumerate(streams)], [])
+    assert sorted(epoch) == list(range(10))
+
+def test_workers_resume_position():
+    ids = take(EpochSampler(10, 3), 60)
+    for start in [0, 7, 11]:
+        for w in range(3):
+            expected = [ids[p] for p in range(start, 60) if p % 3 == w][:10]
+            assert take(EpochSampler(10, 3, start, w, 3), 10) == expected
+
+def test_mixed_ids():
+    ids = take(MixedSampler([5, 8], [1, 3], 2), 200)
+    assert set(ids) == set(range(13))
+    # the draws of each dataset follow its own stream
+    assert [i for i in ids if i < 5][:10] == take(EpochSampler(5, [2, 0]), 10)
+    assert [i-5 for i in ids if i >= 5][:10] == take(EpochSampler(8, [2, 1]), 10)
+
+def test_mixed_streams_are_independent():
+    # dataset 0 at epoch 1 doesn't repeat dataset 1 at epoch 0
+    samplers = MixedSampler([10, 10], [1, 1], 2).samplers
+    a = take(samplers[0], 20)
+    b = take(samplers[1], 10)
+    assert a[10:] != b
+
+def test_mixed_replay():
+    ids = take(MixedSampler([5, 8], [1, 3], 2), 40)
+    for start in [0, 9, 17]:
+        assert take(MixedSampler([5, 8], [1, 3], 2, start), 10) == ids[start:start+10]
+
+def test_mixed_workers_replay():
+    for w in range(2):
+        ids = take(MixedSampler([5, 8], [1, 3], 2, 0, w, 2), 30)
+        for start in [0, 9, 17]:
+            skip = len(range(w, start, 2))
+            assert take(MixedSampler([5, 8], [1, 3], 2, start, w, 2), 10) == ids[skip:skip+10]
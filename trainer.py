@@ -1,6 +1,7 @@
 from __future__ import print_function
 
 import os
+import multiprocessing
 import numpy as np
 from tqdm import trange
 from datetime import datetime
@@ -8,28 +9,83 @@ import time
 
 from model import *
 from util import *
+from data_tool import code_dir, read_code_index, write_code_shard
 
 class Trainer(object):
-    def __init__(self, config, batch_manager):
+    def __init__(self, config, batch_manager, allreduce=None):
         self.config = config
 
         self.batch_manager = batch_manager
-        self.x, self.y = batch_manager.batch() # normalized input
+        self.crop = getattr(batch_manager, 'crop', None)
 
         self.is_3d = config.is_3d
         self.dataset = config.dataset
         self.data_type = config.data_type
         self.arch = config.arch
 
+        batch = self.next_batch() # normalized input
+
+        self.steps_per_call = config.steps_per_call if config.is_train else 1
+        self.train_loop = None
+        if self.steps_per_call > 1 and config.staging:
+            raise Exception("[!] --steps_per_call dequeues inside the graph, no --staging")
+
+        # activations recomputed in the backward pass of 3d models (see conv_block3)
+        self.recompute = config.recompute if config.is_train else 'none'
+        if self.recompute != 'none' and not self.is_3d:
+            raise Exception("[!] --recompute is only supported for 3d models")
+
+        if self.steps_per_call > 1 or self.recompute != 'none':
+            # variables read in the in-graph loop (see build_loop) need to be
+            # resource variables, ref variables would be read once per call.
+            # recompute_grad (a custom gradient) only takes resource variables
+            tf.get_variable_scope().set_use_resource(True)
+
+        # mixed precision: the models run their conv stacks in half_dtype and
+        # keep float32 variables (see master_getter), losses stay float32
+        self.dtype = tf.float32
+        if config.precision == 'mixed':
+            if 'nn' in self.arch:
+                raise Exception("[!] --precision=mixed is only supported for the conv models")
+            self.dtype = tf.as_dtype(config.half_dtype)
+        self.loss_scale = config.loss_scale
+
+        # data-parallel replica (see replicas.py), gradients are averaged with allreduce
+        self.allreduce = allreduce if config.is_train else None
+        self.replica = getattr(config, 'replica', 0)
+        self.is_chief = self.replica == 0
+        self.grads, self.grad_phs = [], []
+        if self.allreduce is not None:
+            if 'nn' in self.arch or self.steps_per_call > 1:
+                raise Exception("[!] --num_replicas is not supported for nn or with --steps_per_call")
+
+        # optimizer steps on the mean gradient of accum_steps batches
+        self.accum_steps = config.accum_steps if config.is_train else 1
+        self.accum_ops = []
+        if self.accum_steps > 1:
+            if 'nn' in self.arch or self.steps_per_call > 1:
+                raise Exception("[!] --accum_steps is not supported for nn or with --steps_per_call")
+
+        self.stage = None
+        if config.staging and 'nn' not in self.arch:
+            # the next batch is copied to the device while the current step runs,
+            # falls back to cpu (soft placement) where it still overlaps the input
+            keys = sorted(batch)
+            staged = [batch[k] for k in keys]
+            with tf.device('/gpu:0'):
+                area = tf.contrib.staging.StagingArea(
+                    dtypes=[t.dtype for t in staged],
+                    shapes=[t.shape for t in staged])
+                self.stage = area.put(staged)
+                batch = dict(zip(keys, area.get()))
+
         if 'nn' in self.arch:
             self.xt, self.yt = batch_manager.test_batch()
             self.xtw, self.ytw = batch_manager.test_batch(is_window=True)
-            self.xw, self.yw = batch_manager.batch(is_window=True)
-        else:
-            if self.is_3d:
-                self.x_jaco, self.x_vort = jacobian3(self.x)
-            else:
-                self.x_jaco, self.x_vort = jacobian(self.x)
+        # the batch of the single-step graph (x, y, ...), also used by summaries
+        self.batch = self.batch_targets(batch)
+        for k, v in self.batch.items():
+            setattr(self, k, v)
 
         self.res_x = config.res_x
         self.res_y = config.res_y
@@ -46,19 +102,29 @@ class Trainer(object):
         if 'dg' in self.arch: self.w3 = config.w3
 
         self.use_c = config.use_curl
+        # the generator always spans the whole domain, also when trained on crops
+        if self.crop is not None:
+            domain = [self.res_z, self.res_y, self.res_x]
+        else:
+            domain = get_conv_shape(self.x)[1:-1]
         if self.use_c:
             if self.is_3d:
-                self.output_shape = get_conv_shape(self.x)[1:-1] + [3]
+                self.output_shape = domain + [3]
             else:
-                self.output_shape = get_conv_shape(self.x)[1:-1] + [1]
+                self.output_shape = domain + [1]
         else:
-            self.output_shape = get_conv_shape(self.x)[1:]
+            self.output_shape = domain + get_conv_shape(self.x)[-1:]
 
         self.optimizer = config.optimizer
         self.beta1 = config.beta1
         self.beta2 = config.beta2
 
         self.model_dir = config.model_dir
+        if not self.is_chief:
+            # checkpoints and images are written by the chief
+            self.model_dir = os.path.join(config.model_dir, 'replica%d' % self.replica)
+            if not os.path.exists(self.model_dir):
+                os.makedirs(self.model_dir)
         self.load_path = config.load_path
 
         self.start_step = config.start_step
@@ -67,6 +133,8 @@ class Trainer(object):
         self.max_step = int(config.max_epoch // batch_manager.epochs_per_step)
 
         self.lr_update = config.lr_update
+        self.lr_min = config.lr_min
+        self.lr_max = config.lr_max
         if self.lr_update == 'decay':
             lr_min = config.lr_min
             lr_max = config.lr_max
@@ -104,6 +172,15 @@ class Trainer(object):
         else:
             self.build_model()
 
+        if self.allreduce is not None:
+            # replicas start from all the variables of the chief: weights,
+            # optimizer slots and beta powers, step, lr and loss scale. they go
+            # through the float32 buffer, exact for the int step below 2**24
+            var_list = tf.global_variables()
+            self.var_flat = tf.concat([tf.cast(tf.reshape(v, [-1]), tf.float32) for v in var_list], axis=0)
+            self.var_ph, self.var_assign = self.unflatten(var_list)
+            self.var_assign = tf.group(*[tf.assign(v, tf.cast(u, v.dtype.base_dtype)) for v, u in self.var_assign])
+
         self.saver = tf.train.Saver(max_to_keep=1000)
         self.summary_writer = tf.summary.FileWriter(self.model_dir)
 
@@ -112,51 +189,83 @@ class Trainer(object):
                                 saver=self.saver,
                                 summary_op=None,
                                 summary_writer=self.summary_writer,
-                                save_model_secs=self.save_sec,
+                                save_model_secs=self.save_sec if self.is_chief else 0,
                                 global_step=self.step,
                                 ready_for_local_init_op=None)
 
         gpu_options = tf.GPUOptions(allow_growth=True)
         sess_config = tf.ConfigProto(allow_soft_placement=True,
                                     gpu_options=gpu_options)
+        if self.allreduce is not None:
+            # the cores are shared by the replicas
+            sess_config.intra_op_parallelism_threads = max(
+                multiprocessing.cpu_count() // config.num_replicas, 1)
 
         self.sess = sv.prepare_or_wait_for_session(config=sess_config)
 
+        if self.allreduce is not None:
+            size = max([int(self.var_ph.shape[0])] + [int(ph.shape[0]) for ph in self.grad_phs])
+            self.allreduce.attach(self.replica, size)
+            var_flat = self.allreduce.broadcast(self.sess.run(self.var_flat))
+            self.sess.run(self.var_assign, {self.var_ph: var_flat})
+
         if 'nn' in self.arch:
             self.batch_manager.init_it(self.sess)
             self.log_step = batch_manager.train_steps
 
         elif self.is_train:
             self.batch_manager.start_thread(self.sess)
+            if self.stage is not None:
+                self.sess.run(self.stage)
 
         # dirty way to bypass graph finilization error
         g = tf.get_default_graph()
         g._finalized = False
 
-    def build_model(self):
-        if self.use_c:
-            self.G_s, self.G_var = GeneratorBE(self.y, self.filters, self.output_shape,
-                                               num_conv=self.num_conv, repeat=self.repeat)
-            self.G_ = curl(self.G_s)
+    def next_batch(self):
+        # tensors of a dequeued batch, see BatchManager.batch
+        if 'nn' in self.arch:
+            x, y = self.batch_manager.batch()
+            xw, yw = self.batch_manager.batch(is_window=True)
+            return {'x': x, 'y': y, 'xw': xw, 'yw': yw}
+        return self.batch_manager.batch()
+
+    def batch_targets(self, batch):
+        # the jacobian and vorticity of a generator batch, from its
+        # precomputed jacobians if any (see --precomputed_jaco)
+        if 'nn' in self.arch:
+            return batch
+        batch = dict(batch)
+        if 'x_jaco' in batch:
+            batch['x_vort'] = vort_from_jaco(batch['x_jaco'])
+        elif self.is_3d:
+            batch['x_jaco'], batch['x_vort'] = jacobian3(batch['x'])
         else:
-            self.G_, self.G_var = GeneratorBE(self.y, self.filters, self.output_shape,
-                                              num_conv=self.num_conv, repeat=self.repeat)
-        self.G = denorm_img(self.G_) # for debug
-
-        self.G_jaco_, self.G_vort_ = jacobian(self.G_)
-        self.G_vort = denorm_img(self.G_vort_)
-
-        if 'dg' in self.arch:
-            # discriminator
-            # self.D_x, self.D_var = DiscriminatorPatch(self.x, self.filters)
-            # self.D_G, _ = DiscriminatorPatch(self.G_, self.filters, reuse=True)
-            D_in = tf.concat([self.x, self.x_vort], axis=-1)
-            self.D_x, self.D_var = DiscriminatorPatch(D_in, self.filters)
-            G_in = tf.concat([self.G_, self.G_vort_], axis=-1)
-            self.D_G, _ = DiscriminatorPatch(G_in, self.filters, reuse=True)
-
-        show_all_variables()
+            batch['x_jaco'], batch['x_vort'] = jacobian(batch['x'])
+        return batch
+
+    def unflatten(self, var_list):
+        # placeholder of a flat vector and its pieces shaped like var_list
+        sizes = [int(np.prod(int_shape(v))) for v in var_list]
+        ph = tf.placeholder(tf.float32, [sum(sizes)])
+        return ph, [(v, tf.reshape(u, int_shape(v))) for v, u in zip(var_list, tf.split(ph, sizes))]
+
+    def scale_loss(self, optimizer):
+        # float16 gradients underflow without loss scaling, bfloat16 has the
+        # exponent range of float32. a dynamic scale skips steps with inf/nan
+        # gradients and is lowered, then raised again every 1000 finite steps
+        if self.dtype != tf.float16:
+            return optimizer
+        if self.loss_scale > 0:
+            manager = tf.contrib.mixed_precision.FixedLossScaleManager(self.loss_scale)
+        else:
+            manager = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(2**15, 1000)
+        return tf.contrib.mixed_precision.LossScaleOptimizer(optimizer, manager)
 
+    def build_optimizers(self):
+        # optimizers of G (ae) and D, loss-scaled for float16. D gets its own
+        # loss scale, inf/nan gradients of one network don't skip the steps
+        # or lower the scale of the other
         if self.optimizer == 'adam':
             optimizer = tf.train.AdamOptimizer
             g_optimizer = optimizer(self.g_lr, beta1=self.beta1, beta2=self.beta2)
@@ -165,24 +274,189 @@ class Trainer(object):
             g_optimizer = optimizer(self.g_lr)
         else:
             raise Exception("[!] Invalid opimizer")
+        self.g_optimizer = self.scale_loss(g_optimizer)
+        self.d_optimizer = self.scale_loss(g_optimizer) if 'dg' in self.arch else None
+
+    def minimize(self, optimizer, loss, var_list, global_step=None):
+        if global_step is not None and isinstance(optimizer, tf.contrib.mixed_precision.LossScaleOptimizer):
+            # a loss-scaled step with inf/nan gradients is skipped together with
+            # its step increment, the step is advanced anyway so that self.step
+            # follows the training loop (lr schedule, logs, checkpoints)
+            with tf.control_dependencies([self.minimize(optimizer, loss, var_list)]):
+                return tf.assign_add(global_step, 1).op
+        if self.allreduce is None and self.accum_steps == 1:
+            return optimizer.minimize(loss, global_step=global_step, var_list=var_list)
+        grads = optimizer.compute_gradients(loss, var_list=var_list)
+        grads = [(g if g is not None else tf.zeros_like(v), v) for g, v in grads]
+
+        if self.allreduce is None:
+            # batch gradients are summed into local variables by accum_ops (not
+            # checkpointed), the step applies their mean and resets them
+            accums = [tf.Variable(tf.zeros(int_shape(v), v.dtype.base_dtype), trainable=False,
+                                  collections=[tf.GraphKeys.LOCAL_VARIABLES]) for _, v in grads]
+            self.accum_ops.append(tf.group(*[tf.assign_add(a, g) for a, (g, _) in zip(accums, grads)]))
+            apply = optimizer.apply_gradients([(a / self.accum_steps, v) for a, (_, v) in zip(accums, grads)],
+                                              global_step=global_step)
+            with tf.control_dependencies([apply]):
+                return tf.group(*[tf.assign(a, tf.zeros_like(a)) for a in accums])
+
+        # the gradients are fetched, averaged over the replicas and fed back (see train_step)
+        self.grads.append(tf.concat([tf.reshape(g, [-1]) for g, _ in grads], axis=0))
+        ph, grads = self.unflatten(var_list)
+        self.grad_phs.append(ph)
+        return optimizer.apply_gradients([(g, v) for v, g in grads], global_step=global_step)
+
+    def lr_update_op(self):
+        # g_lr_update for the in-graph loop, after the optimizer increased the step
+        step = tf.cast(self.step.read_value(), tf.float32)
+        if self.lr_update == 'decay':
+            lr = self.lr_min+0.5*(self.lr_max-self.lr_min)*(tf.cos(step*np.pi/self.max_step)+1)
+        else:
+            g_lr = self.g_lr.read_value()
+            lr = tf.where(tf.equal(tf.mod(step, self.lr_update_step), 0),
+                          tf.maximum(g_lr*0.5, self.lr_min), g_lr)
+        return tf.assign(self.g_lr, lr)
+
+    def objectives(self, t):
+        # (optimizer, loss, variables, global step) of each optimizer step
+        # on the losses t of a batch
+        if 'ae' in self.arch or 'nn' in self.arch:
+            return [(self.g_optimizer, t['loss'], t['var'], self.step)]
+        objectives = []
+        if 'dg' in self.arch:
+            objectives.append((self.d_optimizer, t['d_loss'], t['D_var'], None))
+        objectives.append((self.g_optimizer, t['g_loss'], t['G_var'], self.step))
+        return objectives
+
+    def build_optims(self, build_loss, t):
+        # optimizer steps on the losses t of the single-step graph, and the
+        # in-graph loop over more batches if steps_per_call > 1
+        self.optims = [self.minimize(*o) for o in self.objectives(t)]
+        if self.steps_per_call > 1:
+            self.build_loop(build_loss)
+
+    def build_loop(self, build_loss):
+        # steps_per_call optimizer steps and lr updates in one session call.
+        # every iteration dequeues its own batch and builds its losses with
+        # the shared variables. summaries and tests use the batch of the
+        # single-step graph, which is dequeued (and not trained on) only
+        # when they run, once per log step as without the loop
+        self.loop_steps = tf.placeholder_with_default(self.steps_per_call, [])
+        def body(i):
+            t = build_loss(self.batch_targets(self.next_batch()), reuse=True)
+            optims = [self.minimize(*o) for o in self.objectives(t)]
+            with tf.control_dependencies(optims):
+                lr_update = self.lr_update_op()
+            with tf.control_dependencies([lr_update]):
+                return i + 1
+        self.train_loop = tf.while_loop(lambda i: i < self.loop_steps, body, [tf.constant(0)],
+                                        parallel_iterations=1)
+
+    def train_step(self, optims, step):
+        # the optimizer step(s) from step on, returns the last step taken
+        if self.allreduce is not None:
+            grads = self.run(self.grads)
+            for _ in range(self.accum_steps-1):
+                grads = [g + g_ for g, g_ in zip(grads, self.run(self.grads))]
+            if self.accum_steps > 1:
+                grads = [g / self.accum_steps for g in grads]
+            splits = np.cumsum([g.size for g in grads])[:-1]
+            grads = np.split(self.allreduce.mean(np.concatenate(grads)), splits)
+            self.sess.run(optims, dict(zip(self.grad_phs, grads)))
+            if step == self.start_step:
+                self.check_replicas()
+            return step
+        if self.accum_steps > 1:
+            for _ in range(self.accum_steps):
+                self.run(self.accum_ops)
+            self.sess.run(optims)
+            return step
+        if self.train_loop is None:
+            self.run(optims)
+            return step
+        num = min(self.steps_per_call, self.max_step - step)
+        self.sess.run(self.train_loop, {self.loop_steps: num})
+        return step + num - 1
+
+    def check_replicas(self):
+        # the replicas apply the same mean gradients to the same variables,
+        # after a step they still have to match the chief's
+        var_flat = self.sess.run(self.var_flat)
+        if not np.array_equal(self.allreduce.broadcast(var_flat), var_flat):
+            raise Exception("[!] replica %d: variables differ from replica 0" % self.replica)
+
+    def update_lr(self, step):
+        if self.train_loop is not None:
+            return # in the loop
+        if self.lr_update == 'step':
+            if step % self.lr_update_step == self.lr_update_step - 1:
+                self.sess.run(self.g_lr_update)
+        else:
+            self.sess.run(self.g_lr_update)
+
+    def save_last(self):
+        if not self.is_chief:
+            return
+        save_path = os.path.join(self.model_dir, 'model.ckpt')
+        self.saver.save(self.sess, save_path, global_step=self.step)
+
+    def due(self, first, last, every):
+        # whether steps first..last of a call include a multiple of every
+        return last // every > (first - 1) // every
+
+    def build_loss(self, b, reuse=False):
+        # generator (and discriminator) losses on the batch b, returns the tensors
+        t = {}
+        if self.use_c:
+            t['G_s'], t['G_var'] = GeneratorBE(b['y'], self.filters, self.output_shape,
+                                               num_conv=self.num_conv, repeat=self.repeat, reuse=reuse, dtype=self.dtype)
+            t['G_'] = curl(t['G_s'])
+        else:
+            t['G_'], t['G_var'] = GeneratorBE(b['y'], self.filters, self.output_shape,
+                                              num_conv=self.num_conv, repeat=self.repeat, reuse=reuse, dtype=self.dtype)
+        t['G'] = denorm_img(t['G_']) # for debug
+
+        t['G_jaco_'], t['G_vort_'] = jacobian(t['G_'])
+        t['G_vort'] = denorm_img(t['G_vort_'])
+
+        if 'dg' in self.arch:
+            # discriminator
+            # D_x, D_var = DiscriminatorPatch(b['x'], self.filters)
+            # D_G, _ = DiscriminatorPatch(G_, self.filters, reuse=True)
+            D_in = tf.concat([b['x'], b['x_vort']], axis=-1)
+            t['D_x'], t['D_var'] = DiscriminatorPatch(D_in, self.filters, reuse=reuse, dtype=self.dtype)
+            G_in = tf.concat([t['G_'], t['G_vort_']], axis=-1)
+            t['D_G'], _ = DiscriminatorPatch(G_in, self.filters, reuse=True, dtype=self.dtype)
 
         # losses
-        self.g_loss_l1 = tf.reduce_mean(tf.abs(self.G_ - self.x))
-        self.g_loss_j_l1 = tf.reduce_mean(tf.abs(self.G_jaco_ - self.x_jaco))
-        self.g_loss = self.g_loss_l1*self.w1 + self.g_loss_j_l1*self.w2
+        t['g_loss_l1'] = tf.reduce_mean(tf.abs(t['G_'] - b['x']))
+        t['g_loss_j_l1'] = tf.reduce_mean(tf.abs(t['G_jaco_'] - b['x_jaco']))
+        t['g_loss'] = t['g_loss_l1']*self.w1 + t['g_loss_j_l1']*self.w2
 
         if 'dg' in self.arch:
-            self.g_loss_real = tf.reduce_mean(tf.square(self.D_G-1))
-            self.d_loss_fake = tf.reduce_mean(tf.square(self.D_G))
-            self.d_loss_real = tf.reduce_mean(tf.square(self.D_x-1))
+            t['g_loss_real'] = tf.reduce_mean(tf.square(t['D_G']-1))
+            t['d_loss_fake'] = tf.reduce_mean(tf.square(t['D_G']))
+            t['d_loss_real'] = tf.reduce_mean(tf.square(t['D_x']-1))
 
-            self.g_loss += self.g_loss_real*self.w3
+            t['g_loss'] += t['g_loss_real']*self.w3
 
-            self.d_loss = self.d_loss_real + self.d_loss_fake
-            self.d_optim = g_optimizer.minimize(self.d_loss, var_list=self.D_var)
+            t['d_loss'] = t['d_loss_real'] + t['d_loss_fake']
+        return t
+
+    def build_model(self):
+        t = self.build_loss(self.batch)
+        vars(self).update(t)
+
+        show_all_variables()
+
+        self.build_optimizers()
+
+        self.build_optims(self.build_loss, t)
+        self.g_optim = self.optims[-1]
+        if 'dg' in self.arch: self.d_optim = self.optims[0]
 
-        self.g_optim = g_optimizer.minimize(self.g_loss, global_step=self.step, var_list=self.G_var)
         self.epoch = tf.placeholder(tf.float32)
+        self.step_sec = tf.placeholder(tf.float32)
 
         # summary
         summary = [
@@ -194,7 +468,7 @@ class Trainer(object):
             tf.summary.scalar("loss/g_loss_j_l1", self.g_loss_j_l1),
 
             tf.summary.scalar("misc/epoch", self.epoch),
-            tf.summary.scalar('misc/q', self.batch_manager.q.size()),
+            tf.summary.scalar("misc/step_sec", self.step_sec),
 
             tf.summary.histogram("y", self.y),
 
@@ -213,6 +487,7 @@ class Trainer(object):
                 tf.summary.scalar("loss/d_loss_fake", tf.sqrt(self.d_loss_fake)),
             ]
 
+        summary += self.batch_manager.summary()
         self.summary_op = tf.summary.merge(summary)
 
         summary = [
@@ -221,6 +496,12 @@ class Trainer(object):
         ]
         self.summary_once = tf.summary.merge(summary) # call just once
 
+    def run(self, fetches, feed_dict=None):
+        # runs that consume a batch also stage the next one
+        if self.stage is None:
+            return self.sess.run(fetches, feed_dict=feed_dict)
+        return self.sess.run([fetches, self.stage], feed_dict=feed_dict)[0]
+
     def train(self):
         if 'ae' in self.arch:
             self.train_ae()
@@ -257,39 +538,37 @@ class Trainer(object):
         z_samples.append(zi)
 
         # call once
-        summary_once = self.sess.run(self.summary_once)
+        summary_once = self.run(self.summary_once)
         self.summary_writer.add_summary(summary_once, 0)
         self.summary_writer.flush()
 
         # train
-        for step in trange(self.start_step, self.max_step):
-            if 'dg' in self.arch:
-                self.sess.run([self.g_optim, self.d_optim])
-            else:
-                self.sess.run(self.g_optim)
-
-            if step % self.log_step == 0 or step == self.max_step-1:
+        step_time, num_steps = 0, 0
+        for step in trange(self.start_step, self.max_step, self.steps_per_call):
+            t = time.time()
+            first, step = step, self.train_step(self.optims, step)
+            step_time += time.time() - t
+            num_steps += step - first + 1
+
+            if self.due(first, step, self.log_step) or step == self.max_step-1:
                 ep = step*self.batch_manager.epochs_per_step
-                loss, summary = self.sess.run([self.g_loss,self.summary_op],
-                                              feed_dict={self.epoch: ep})
+                step_sec = step_time / num_steps
+                step_time, num_steps = 0, 0
+                loss, summary = self.run([self.g_loss,self.summary_op],
+                                              feed_dict={self.epoch: ep, self.step_sec: step_sec})
                 assert not np.isnan(loss), 'Model diverged with loss = NaN'
-                print("\n[{}/{}/ep{:.2f}] Loss: {:.6f}".format(step, self.max_step, ep, loss))
+                print("\n[{}/{}/ep{:.2f}] Loss: {:.6f} ({:.3f} sec/step)".format(step, self.max_step, ep, loss, step_sec))
 
                 self.summary_writer.add_summary(summary, global_step=step)
                 self.summary_writer.flush()
 
-            if step % self.test_step == 0 or step == self.max_step-1:
+            if self.due(first, step, self.test_step) or step == self.max_step-1:
                 self.generate(z_samples, self.model_dir, idx=step)
 
-            if self.lr_update == 'step':
-                if step % self.lr_update_step == self.lr_update_step - 1:
-                    self.sess.run(self.g_lr_update)
-            else:
-                self.sess.run(self.g_lr_update)
+            self.update_lr(step)
 
         # save last checkpoint..
-        save_path = os.path.join(self.model_dir, 'model.ckpt')
-        self.saver.save(self.sess, save_path, global_step=self.step)
+        self.save_last()
         self.batch_manager.stop_thread()
 
     def build_test_model(self):
@@ -297,11 +576,11 @@ class Trainer(object):
         self.z = tf.placeholder(dtype=tf.float32, shape=[self.test_b_num, self.c_num])
         if self.use_c:
             self.G_s, _ = GeneratorBE(self.z, self.filters, self.output_shape,
-                                      num_conv=self.num_conv, repeat=self.repeat, reuse=True)
+                                      num_conv=self.num_conv, repeat=self.repeat, reuse=True, dtype=self.dtype)
             self.G_ = curl(self.G_s)
         else:
             self.G_, _ = GeneratorBE(self.z, self.filters, self.output_shape,
-                                     num_conv=self.num_conv, repeat=self.repeat, reuse=True)
+                                     num_conv=self.num_conv, repeat=self.repeat, reuse=True, dtype=self.dtype)
 
     def test(self):
         if 'ae' in self.arch:
@@ -369,46 +648,47 @@ class Trainer(object):
                             f.write(',%s' % G_[fd,sd,td,1])
                             f.write(',%s' % G_[fd,sd,td,2])
 
-    def build_model_ae(self):
+    def build_loss_ae(self, b, reuse=False):
+        # autoencoder losses on the batch b, returns the tensors
+        t = {}
         if self.use_c:
-            self.s, self.z, self.var = AE(self.x, self.filters, self.z_num, use_sparse=self.use_sparse,
-                                          num_conv=self.num_conv, repeat=self.repeat)
-            self.x_ = curl(self.s)
+            t['s'], t['z'], t['var'] = AE(b['x'], self.filters, self.z_num, use_sparse=self.use_sparse,
+                                          num_conv=self.num_conv, repeat=self.repeat, reuse=reuse, dtype=self.dtype)
+            t['x_'] = curl(t['s'])
         else:
-            self.x_, self.z, self.var = AE(self.x, self.filters, self.z_num, use_sparse=self.use_sparse,
-                                              num_conv=self.num_conv, repeat=self.repeat)
-        self.x_img = denorm_img(self.x_) # for debug
-
-        self.x_jaco_, self.x_vort_ = jacobian(self.x_)
-        self.x_vort_ = denorm_img(self.x_vort_)
+            t['x_'], t['z'], t['var'] = AE(b['x'], self.filters, self.z_num, use_sparse=self.use_sparse,
+                                              num_conv=self.num_conv, repeat=self.repeat, reuse=reuse, dtype=self.dtype)
+        t['x_img'] = denorm_img(t['x_']) # for debug
 
-        show_all_variables()
-
-        if self.optimizer == 'adam':
-            optimizer = tf.train.AdamOptimizer
-            g_optimizer = optimizer(self.g_lr, beta1=self.beta1, beta2=self.beta2)
-        elif self.optimizer == 'gd':
-            optimizer = tf.train.GradientDescentOptimizer
-            g_optimizer = optimizer(self.g_lr)
-        else:
-            raise Exception("[!] Invalid opimizer")
+        t['x_jaco_'], x_vort_ = jacobian(t['x_'])
+        t['x_vort_'] = denorm_img(x_vort_)
 
         # losses
-        self.loss_l1 = tf.reduce_mean(tf.abs(self.x_ - self.x))
-        self.loss_j_l1 = tf.reduce_mean(tf.abs(self.x_jaco_ - self.x_jaco))
+        t['loss_l1'] = tf.reduce_mean(tf.abs(t['x_'] - b['x']))
+        t['loss_j_l1'] = tf.reduce_mean(tf.abs(t['x_jaco_'] - b['x_jaco']))
 
-        y = self.y[:,:,-1]
-        self.loss_p = tf.reduce_mean(tf.squared_difference(y, self.z[:,-self.p_num:]))
-        self.loss = self.loss_l1*self.w1 + self.loss_j_l1*self.w2 + self.loss_p*self.w4
+        t['loss_p'] = tf.reduce_mean(tf.squared_difference(b['y'][:,:,-1], t['z'][:,-self.p_num:]))
+        t['loss'] = t['loss_l1']*self.w1 + t['loss_j_l1']*self.w2 + t['loss_p']*self.w4
 
         if self.use_sparse:
             ds = tf.distributions
             rho = ds.Bernoulli(probs=self.sparsity)
-            rho_ = ds.Bernoulli(probs=tf.reduce_mean(self.z[:,:-self.p_num], axis=0))
-            self.loss_kl = tf.reduce_sum(ds.kl_divergence(rho, rho_))
-            self.loss += self.loss_kl*self.w5
+            rho_ = ds.Bernoulli(probs=tf.reduce_mean(t['z'][:,:-self.p_num], axis=0))
+            t['loss_kl'] = tf.reduce_sum(ds.kl_divergence(rho, rho_))
+            t['loss'] += t['loss_kl']*self.w5
+        return t
+
+    def build_model_ae(self):
+        t = self.build_loss_ae(self.batch)
+        vars(self).update(t)
+
+        show_all_variables()
+
+        self.build_optimizers()
+
+        self.build_optims(self.build_loss_ae, t)
+        self.optim = self.optims[0]
 
-        self.optim = g_optimizer.minimize(self.loss, global_step=self.step, var_list=self.var)
         self.epoch = tf.placeholder(tf.float32)
 
         # summary
@@ -422,9 +702,8 @@ class Trainer(object):
             tf.summary.scalar("loss/loss_p", self.loss_p),
 
             tf.summary.scalar("misc/epoch", self.epoch),
-            tf.summary.scalar('misc/q', self.batch_manager.q.size()),
 
-            tf.summary.histogram("y", y),
+            tf.summary.histogram("y", self.y[:,:,-1]),
             tf.summary.histogram("z", self.z),
 
             tf.summary.scalar("misc/g_lr", self.g_lr),
@@ -435,6 +714,7 @@ class Trainer(object):
                 tf.summary.scalar("loss/loss_kl", self.loss_kl),
             ]
 
+        summary += self.batch_manager.summary()
         self.summary_op = tf.summary.merge(summary)
 
     def train_ae(self):
@@ -448,12 +728,12 @@ class Trainer(object):
             f.write(str(zi_))
 
         # train
-        for step in trange(self.start_step, self.max_step):
-            self.sess.run(self.optim)
+        for step in trange(self.start_step, self.max_step, self.steps_per_call):
+            first, step = step, self.train_step(self.optims, step)
 
-            if step % self.log_step == 0 or step == self.max_step-1:
+            if self.due(first, step, self.log_step) or step == self.max_step-1:
                 ep = step*self.batch_manager.epochs_per_step
-                loss, summary = self.sess.run([self.loss,self.summary_op],
+                loss, summary = self.run([self.loss,self.summary_op],
                                               feed_dict={self.epoch: ep})
 
                 assert not np.isnan(loss), 'Model diverged with loss = NaN'
@@ -462,29 +742,24 @@ class Trainer(object):
                 self.summary_writer.add_summary(summary, global_step=step)
                 self.summary_writer.flush()
 
-            if step % self.test_step == 0 or step == self.max_step-1:
+            if self.due(first, step, self.test_step) or step == self.max_step-1:
                 self.autoencode(x, self.model_dir, idx=step)
 
-            if self.lr_update == 'step':
-                if step % self.lr_update_step == self.lr_update_step - 1:
-                    self.sess.run(self.g_lr_update)
-            else:
-                self.sess.run(self.g_lr_update)
+            self.update_lr(step)
 
         # save last checkpoint..
-        save_path = os.path.join(self.model_dir, 'model.ckpt')
-        self.saver.save(self.sess, save_path, global_step=self.step)
+        self.save_last()
         self.batch_manager.stop_thread()
 
     def build_test_model_ae(self):
         self.x = tf.placeholder(dtype=tf.float32, shape=[self.test_b_num, self.res_y, self.res_x, 2])
         if self.use_c:
             self.s, self.z, self.var = AE(self.x, self.filters, self.z_num, use_sparse=self.use_sparse,
-                                          num_conv=self.num_conv, repeat=self.repeat, reuse=True)
+                                          num_conv=self.num_conv, repeat=self.repeat, reuse=True, dtype=self.dtype)
             self.x_ = curl(self.s)
         else:
             self.x_, self.z, self.var = AE(self.x, self.filters, self.z_num, use_sparse=self.use_sparse,
-                                              num_conv=self.num_conv, repeat=self.repeat, reuse=True)
+                                              num_conv=self.num_conv, repeat=self.repeat, reuse=True, dtype=self.dtype)
         self.x_img = denorm_img(self.x_)
 
     def test_ae(self):
@@ -509,35 +784,28 @@ class Trainer(object):
                 dx_list = (nx[:,1:] - nx[:,:-1]).reshape([-1, 1])
                 p_list = dx_list
 
+            p_list = p_list.reshape([num_sims, num_frames-1, -1])
+
+            # scenes already encoded with this checkpoint are skipped
+            code_path = code_dir(self.load_path, self.z_num)
+            ckpt = os.path.basename(tf.train.latest_checkpoint(self.load_path) or '')
+            index = read_code_index(code_path)
+            todo = [i for i in range(num_sims) if index.get(str(i)) != ckpt]
+            print('%s: encode %d/%d scenes to %s' % (datetime.now(), len(todo), num_sims, code_path))
+
             from tqdm import tqdm
-            c_list = []
-            num_iter = num_sims*num_frames/self.test_b_num
-            for x, _ in tqdm(self.batch_manager.batch_(self.test_b_num),
+            c_list = np.zeros([0, self.z_num], dtype=np.float32)
+            scenes = list(todo)
+            num_iter = int(np.ceil(len(todo)*num_frames/self.test_b_num))
+            for x, mask in tqdm(self.batch_manager.batch_(self.test_b_num, scenes=todo),
                             total=num_iter):
                 c = self.sess.run(self.z, {self.x: x})
-                c_list.append(c)
-
-            c_list = np.concatenate(c_list)
-            x_list = []
-            y_list = []
-
-            for i in range(num_sims):
-                s1 = i*num_frames
-                s2 = (i+1)*num_frames
-                x_list.append(c_list[s1:s2-1,:])
-                y_list.append(c_list[s1+1:s2,:])
-
-            x_list = np.concatenate(x_list)
-            y_list = np.concatenate(y_list)
-            print(x_list.shape, y_list.shape, p_list.shape)
-
-            code_path = os.path.join(self.load_path, 'code%d.npz' % self.z_num)
-            np.savez_compressed(code_path,
-                                x=x_list,
-                                y=y_list,
-                                p=p_list,
-                                s=num_sims,
-                                f=num_frames)
+                c_list = np.concatenate((c_list, c[mask]))
+                while c_list.shape[0] >= num_frames:
+                    i = scenes.pop(0)
+                    write_code_shard(code_path, i, ckpt, c_list[:num_frames], p_list[i])
+                    c_list = c_list[num_frames:]
+
         else:
             # reconstruct velocity from latent codes
             code_path = os.path.join(self.code_path, 'code_out.npz')
@@ -598,38 +866,45 @@ class Trainer(object):
                 # np.savez_compressed(v_path, v=v, v_gt=v_gt)
 
 
-    def build_model_nn(self):
-        self.y_, self.var = NN(self.x, self.filters, self.z_num)
-        self.yt_, _ = NN(self.xt, self.filters, self.z_num, train=False, reuse=True)
+    def build_loss_nn(self, b, reuse=False, train=True):
+        # losses of the next code and of the w_num windowed steps on the batch b,
+        # returns the tensors
+        t = {}
+        t['y_'], t['var'] = NN(b['x'], self.filters, self.z_num, train=train, reuse=reuse)
 
-        x_ = self.xw[:,0,:]
-        xt_ = self.xtw[:,0,:]
+        x_ = b['xw'][:,0,:]
         yw_ = None
-        ytw_ = None
         for i in range(self.w_num):
-            y_, _ = NN(x_, self.filters, self.z_num, reuse=True)
-            yt_, _ = NN(xt_, self.filters, self.z_num, train=False, reuse=True)
+            y_, _ = NN(x_, self.filters, self.z_num, train=train, reuse=True)
             yw = tf.expand_dims(y_, 1)
-            yt = tf.expand_dims(yt_, 1)
             if yw_ is None:
                 yw_ = yw
             else:
                 yw_ = tf.concat((yw_, yw), axis=1)
-            if ytw_ is None:
-                ytw_ = yt
-            else:
-                ytw_ = tf.concat((ytw_, yt), axis=1)
 
             if i < self.w_num-1:
                 # re-normalized to the scale of x
                 y_ *= (self.batch_manager.out_std / self.batch_manager.code_std)
-                yt_ *= (self.batch_manager.out_std / self.batch_manager.code_std)
 
-                x_ = tf.concat([tf.add(x_[:,:-self.p_num], y_), self.xw[:,i+1,-self.p_num:]], axis=-1)
-                xt_ = tf.concat([tf.add(xt_[:,:-self.p_num], yt_), self.xtw[:,i+1,-self.p_num:]], axis=-1)
+                x_ = tf.concat([tf.add(x_[:,:-self.p_num], y_), b['xw'][:,i+1,-self.p_num:]], axis=-1)
 
-        self.yw_ = yw_
-        self.ytw_ = ytw_
+        t['yw_'] = yw_
+
+        # losses
+        t['loss_train'] = tf.losses.mean_squared_error(b['y'], t['y_'])
+        t['loss_train_w'] = tf.losses.mean_squared_error(b['yw'], t['yw_'])
+        # t['loss'] = t['loss_train']*self.w1 + t['loss_train_w']*self.w2
+        t['loss'] = t['loss_train_w']
+        # t['loss'] = t['loss_train']
+        return t
+
+    def build_model_nn(self):
+        t = self.build_loss_nn(self.batch)
+        vars(self).update(t)
+        tt = self.build_loss_nn({'x': self.xt, 'y': self.yt, 'xw': self.xtw, 'yw': self.ytw},
+                                reuse=True, train=False)
+        self.yt_, self.ytw_ = tt['y_'], tt['yw_']
+        self.l_test, self.l_test_w = tt['loss_train'], tt['loss_train_w']
 
         show_all_variables()
 
@@ -638,21 +913,13 @@ class Trainer(object):
         else:
             raise Exception("[!] Caution! Paper didn't use {} opimizer other than Adam".format(self.optimizer))
 
-        optimizer = optimizer(self.g_lr, beta1=self.beta1, beta2=self.beta2)
+        self.g_optimizer = optimizer(self.g_lr, beta1=self.beta1, beta2=self.beta2)
 
-        # losses
-        self.loss_train = tf.losses.mean_squared_error(self.y, self.y_)
-        self.loss_train_w = tf.losses.mean_squared_error(self.yw, self.yw_)
-        # self.loss = self.loss_train*self.w1 + self.loss_train_w*self.w2
-        self.loss = self.loss_train_w
-        # self.loss = self.loss_train
+        self.build_optims(self.build_loss_nn, t)
+        self.optim = self.optims[0]
 
-        self.l_test = tf.losses.mean_squared_error(self.yt, self.yt_)
         self.loss_test = tf.placeholder(tf.float32)
-        self.l_test_w = tf.losses.mean_squared_error(self.ytw, self.ytw_)
         self.loss_test_w = tf.placeholder(tf.float32)
-
-        self.optim = optimizer.minimize(self.loss, global_step=self.step, var_list=self.var)
         self.epoch = tf.placeholder(tf.float32)
 
         # summary
@@ -672,24 +939,28 @@ class Trainer(object):
     def train_nn(self):
         # train
         ep = 0
-        for step in trange(self.start_step, self.max_step):
-            self.sess.run(self.optim)
+        for step in trange(self.start_step, self.max_step, self.steps_per_call):
+            first, step = step, self.train_step(self.optims, step)
 
-            if step % self.log_step == 0 or step == self.max_step-1:
+            if self.due(first, step, self.log_step) or step == self.max_step-1:
                 ep += 1
 
-                self.batch_manager.init_test_it()
-                test_loss = 0.0
-                for t in range(self.batch_manager.test_steps):
-                    tl = self.sess.run(self.l_test)
-                    test_loss += tl
-                test_loss /= self.batch_manager.test_steps
-
-                test_loss_w = 0.0
-                for t in range(self.batch_manager.test_w_steps):
-                    tl = self.sess.run(self.l_test_w)
-                    test_loss_w += tl
-                test_loss_w /= self.batch_manager.test_w_steps
+                # nan without test rows, the test datasets are empty then
+                test_loss = np.nan
+                if self.batch_manager.test_steps > 0:
+                    test_loss = 0.0
+                    for t in range(self.batch_manager.test_steps):
+                        tl = self.sess.run(self.l_test)
+                        test_loss += tl
+                    test_loss /= self.batch_manager.test_steps
+
+                test_loss_w = np.nan
+                if self.batch_manager.test_w_steps > 0:
+                    test_loss_w = 0.0
+                    for t in range(self.batch_manager.test_w_steps):
+                        tl = self.sess.run(self.l_test_w)
+                        test_loss_w += tl
+                    test_loss_w /= self.batch_manager.test_w_steps
 
                 loss, summary = self.sess.run([self.loss,self.summary_op],
                     feed_dict={self.epoch: ep, self.loss_test: test_loss,
@@ -700,15 +971,10 @@ class Trainer(object):
                 self.summary_writer.add_summary(summary, global_step=step)
                 self.summary_writer.flush()
 
-            if self.lr_update == 'step':
-                if step % self.lr_update_step == self.lr_update_step - 1:
-                    self.sess.run(self.g_lr_update)
-            else:
-                self.sess.run(self.g_lr_update)
+            self.update_lr(step)
 
         # save last checkpoint..
-        save_path = os.path.join(self.model_dir, 'model.ckpt')
-        self.saver.save(self.sess, save_path, global_step=self.step)
+        self.save_last()
 
     def test_nn(self):
         self.x = tf.placeholder(dtype=tf.float32, shape=[1, self.z_num+self.p_num])
@@ -11,63 +11,91 @@ from util import *
 from trainer import Trainer
 
 class Trainer3(Trainer):
-    def build_model(self):
+    def crop_arg(self, b):
+        # train on the sub-volumes of the batch b, test models use the whole domain
+        if self.crop is None:
+            return None
+        return (b['crop_offset'], self.crop)
+
+    def build_loss(self, b, reuse=False):
+        t = {}
         if self.use_c:
-            self.G_s, self.G_var = GeneratorBE3(self.y, self.filters, self.output_shape,
-                                               num_conv=self.num_conv, repeat=self.repeat)
+            t['G_s'], t['G_var'] = GeneratorBE3(b['y'], self.filters, self.output_shape,
+                                               num_conv=self.num_conv, repeat=self.repeat,
+                                               crop=self.crop_arg(b), reuse=reuse,
+                                              recompute=self.recompute, dtype=self.dtype)
 
-            # print('trainer3.build_model: self.G_s.shape: Pre-jacobian:')
-            # print(self.G_s.shape)
+            # print('trainer3.build_model: G_s.shape: Pre-jacobian:')
+            # print(t['G_s'].shape)
 
-            _, self.G_ = jacobian3(self.G_s)
+            _, t['G_'] = jacobian3(t['G_s'])
 
-            # print('trainer3.build_model: self.G_s.shape: Post-jacobian:')
-            # print(self.G_.shape)
+            # print('trainer3.build_model: G_s.shape: Post-jacobian:')
+            # print(t['G_'].shape)
         else:
-            self.G_, self.G_var = GeneratorBE3(self.y, self.filters, self.output_shape,
-                                              num_conv=self.num_conv, repeat=self.repeat)
-        self.G = denorm_img3(self.G_) # for debug
-        self.G_jaco_, self.G_vort_ = jacobian3(self.G_)
-        self.G_vort = denorm_img3(self.G_vort_)
+            t['G_'], t['G_var'] = GeneratorBE3(b['y'], self.filters, self.output_shape,
+                                              num_conv=self.num_conv, repeat=self.repeat,
+                                              crop=self.crop_arg(b), reuse=reuse,
+                                              recompute=self.recompute, dtype=self.dtype)
+        t['G'] = denorm_img3(t['G_']) # for debug
+        t['G_jaco_'], t['G_vort_'] = jacobian3(t['G_'])
+        t['G_vort'] = denorm_img3(t['G_vort_'])
 
         if 'dg' in self.arch:
             # discriminator
-            # self.D_x, self.D_var = DiscriminatorPatch3(self.x, self.filters)
-            # self.D_G, _ = DiscriminatorPatch3(self.G_, self.filters, reuse=True)
-            D_in = tf.concat([self.x, self.x_vort], axis=-1)
-            self.D_x, self.D_var = DiscriminatorPatch3(D_in, self.filters)
-            G_in = tf.concat([self.G_, self.G_vort_], axis=-1)
-            self.D_G, _ = DiscriminatorPatch3(G_in, self.filters, reuse=True)
+            # D_x, D_var = DiscriminatorPatch3(b['x'], self.filters)
+            # D_G, _ = DiscriminatorPatch3(G_, self.filters, reuse=True)
+            D_in = tf.concat([b['x'], b['x_vort']], axis=-1)
+            t['D_x'], t['D_var'] = DiscriminatorPatch3(D_in, self.filters, reuse=reuse, dtype=self.dtype)
+            G_in = tf.concat([t['G_'], t['G_vort_']], axis=-1)
+            t['D_G'], _ = DiscriminatorPatch3(G_in, self.filters, reuse=True, dtype=self.dtype)
 
+        # losses
+        t['g_loss_l1'] = tf.reduce_mean(tf.abs(t['G_'] - b['x']))
+        t['g_loss_j_l1'] = tf.reduce_mean(tf.abs(t['G_jaco_'] - b['x_jaco']))
+        t['g_loss'] = t['g_loss_l1']*self.w1 + t['g_loss_j_l1']*self.w2
 
-        show_all_variables()
+        if 'dg' in self.arch:
+            t['g_loss_real'] = tf.reduce_mean(tf.square(t['D_G']-1))
+            t['d_loss_fake'] = tf.reduce_mean(tf.square(t['D_G']))
+            t['d_loss_real'] = tf.reduce_mean(tf.square(t['D_x']-1))
+
+            t['g_loss'] += t['g_loss_real']*self.w3
 
-        if self.optimizer == 'adam':
-            optimizer = tf.train.AdamOptimizer
-            g_optimizer = optimizer(self.g_lr, beta1=self.beta1, beta2=self.beta2)
-        elif self.optimizer == 'gd':
-            optimizer = tf.train.GradientDescentOptimizer
-            g_optimizer = optimizer(self.g_lr)
+            t['d_loss'] = t['d_loss_real'] + t['d_loss_fake']
+        return t
+
+    def build_preview(self):
+        # the generator on the whole domain for the images of generate, fed
+        # with its own parameters: the training graph may take a crop_offset
+        # from the input pipeline (and dequeue a staged batch)
+        self.y_preview = tf.placeholder(dtype=tf.float32, shape=int_shape(self.y))
+        if self.use_c:
+            G_s, _ = GeneratorBE3(self.y_preview, self.filters, self.output_shape,
+                                  num_conv=self.num_conv, repeat=self.repeat, reuse=True, dtype=self.dtype)
+            _, G_ = jacobian3(G_s)
         else:
-            raise Exception("[!] Invalid opimizer")
+            G_, _ = GeneratorBE3(self.y_preview, self.filters, self.output_shape,
+                                 num_conv=self.num_conv, repeat=self.repeat, reuse=True, dtype=self.dtype)
+        self.G_preview = denorm_img3(G_)
+        _, G_vort_ = jacobian3(G_)
+        self.G_vort_preview = denorm_img3(G_vort_)
 
-        # losses
-        self.g_loss_l1 = tf.reduce_mean(tf.abs(self.G_ - self.x))
-        self.g_loss_j_l1 = tf.reduce_mean(tf.abs(self.G_jaco_ - self.x_jaco))
-        self.g_loss = self.g_loss_l1*self.w1 + self.g_loss_j_l1*self.w2
+    def build_model(self):
+        t = self.build_loss(self.batch)
+        vars(self).update(t)
 
-        if 'dg' in self.arch:
-            self.g_loss_real = tf.reduce_mean(tf.square(self.D_G-1))
-            self.d_loss_fake = tf.reduce_mean(tf.square(self.D_G))
-            self.d_loss_real = tf.reduce_mean(tf.square(self.D_x-1))
+        show_all_variables()
 
-            self.g_loss += self.g_loss_real*self.w3
+        self.build_optimizers()
 
-            self.d_loss = self.d_loss_real + self.d_loss_fake
-            self.d_optim = g_optimizer.minimize(self.d_loss, var_list=self.D_var)
+        self.build_optims(self.build_loss, t)
+        self.g_optim = self.optims[-1]
+        if 'dg' in self.arch: self.d_optim = self.optims[0]
+        self.build_preview()
 
-        self.g_optim = g_optimizer.minimize(self.g_loss, global_step=self.step, var_list=self.G_var)
         self.epoch = tf.placeholder(tf.float32)
+        self.step_sec = tf.placeholder(tf.float32)
 
         # summary
         summary = [
@@ -86,7 +114,7 @@ class Trainer3(Trainer):
             tf.summary.scalar("loss/g_loss_j_l1", self.g_loss_j_l1),
 
             tf.summary.scalar("misc/epoch", self.epoch),
-            tf.summary.scalar('misc/q', self.batch_manager.q.size()),
+            tf.summary.scalar("misc/step_sec", self.step_sec),
 
             tf.summary.histogram("y", self.y),
 
@@ -100,6 +128,7 @@ class Trainer3(Trainer):
                 tf.summary.scalar("loss/d_loss_fake", tf.sqrt(self.d_loss_fake)),
             ]
 
+        summary += self.batch_manager.summary()
         self.summary_op = tf.summary.merge(summary)
 
         # summary once
@@ -150,39 +179,37 @@ class Trainer3(Trainer):
         z_samples.append(zi)
 
         # call once
-        summary_once = self.sess.run(self.summary_once)
+        summary_once = self.run(self.summary_once)
         self.summary_writer.add_summary(summary_once, 0)
         self.summary_writer.flush()
 
         # train
-        for step in trange(self.start_step, self.max_step):
-            if 'dg' in self.arch:
-                self.sess.run([self.g_optim, self.d_optim])
-            else:
-                self.sess.run(self.g_optim)
-
-            if step % self.log_step == 0 or step == self.max_step-1:
+        step_time, num_steps = 0, 0
+        for step in trange(self.start_step, self.max_step, self.steps_per_call):
+            t = time.time()
+            first, step = step, self.train_step(self.optims, step)
+            step_time += time.time() - t
+            num_steps += step - first + 1
+
+            if self.due(first, step, self.log_step) or step == self.max_step-1:
                 ep = step*self.batch_manager.epochs_per_step
-                loss, summary = self.sess.run([self.g_loss,self.summary_op],
-                                              feed_dict={self.epoch: ep})
+                step_sec = step_time / num_steps
+                step_time, num_steps = 0, 0
+                loss, summary = self.run([self.g_loss,self.summary_op],
+                                              feed_dict={self.epoch: ep, self.step_sec: step_sec})
                 assert not np.isnan(loss), 'Model diverged with loss = NaN'
-                print("\n[{}/{}/ep{:.2f}] Loss: {:.6f}".format(step, self.max_step, ep, loss))
+                print("\n[{}/{}/ep{:.2f}] Loss: {:.6f} ({:.3f} sec/step)".format(step, self.max_step, ep, loss, step_sec))
 
                 self.summary_writer.add_summary(summary, global_step=step)
                 self.summary_writer.flush()
 
-            if step % self.test_step == 0 or step == self.max_step-1:
+            if self.due(first, step, self.test_step) or step == self.max_step-1:
                 self.generate(z_samples, self.model_dir, idx=step)
 
-            if self.lr_update == 'step':
-                if step % self.lr_update_step == self.lr_update_step - 1:
-                    self.sess.run(self.g_lr_update)
-            else:
-                self.sess.run(self.g_lr_update)
+            self.update_lr(step)
 
         # save last checkpoint..
-        save_path = os.path.join(self.model_dir, 'model.ckpt')
-        self.saver.save(self.sess, save_path, global_step=self.step)
+        self.save_last()
         self.batch_manager.stop_thread()
 
 
@@ -191,12 +218,12 @@ class Trainer3(Trainer):
         self.z = tf.placeholder(dtype=tf.float32, shape=[self.test_b_num, self.c_num])
         if self.use_c:
             self.G_s, _ = GeneratorBE3(self.z, self.filters, self.output_shape,
-                                      num_conv=self.num_conv, repeat=self.repeat, reuse=True)
+                                      num_conv=self.num_conv, repeat=self.repeat, reuse=True, dtype=self.dtype)
             # self.G_ = curl(self.G_s)
             _, self.G_ = jacobian3(self.G_s)
         else:
             self.G_, _ = GeneratorBE3(self.z, self.filters, self.output_shape,
-                                     num_conv=self.num_conv, repeat=self.repeat, reuse=True)
+                                     num_conv=self.num_conv, repeat=self.repeat, reuse=True, dtype=self.dtype)
         self.G_denorm = denorm_gen(self.G_)
 
         self.zyImgPlane = tf.transpose(
@@ -336,7 +363,7 @@ class Trainer3(Trainer):
 
         for _, z_sample in enumerate(inputs):
             xym, zym = self.sess.run( # xy, zy,
-                [self.G['xym'], self.G['zym']], {self.y: z_sample}) # self.G['xy'], self.G['zy'],
+                [self.G_preview['xym'], self.G_preview['zym']], {self.y_preview: z_sample}) # self.G['xy'], self.G['zy'],
             print('xym.shape:')
             print(xym.shape)
             print('zym.shape:')
@@ -348,7 +375,7 @@ class Trainer3(Trainer):
             zym_list.append(zym)
 
             xym, zym = self.sess.run( # xy, zy,
-                [self.G_vort['xym'], self.G_vort['zym']], {self.y: z_sample}) # self.G_vort['xy'], self.G_vort['zy'],
+                [self.G_vort_preview['xym'], self.G_vort_preview['zym']], {self.y_preview: z_sample}) # self.G_vort['xy'], self.G_vort['zy'],
             print('xym.shape:')
             print(xym.shape)
             print('zym.shape:')
@@ -380,46 +407,48 @@ class Trainer3(Trainer):
         print("[*] Samples saved: {}".format(x_zy_path))
 
 
-    def build_model_ae(self):
+    def build_loss_ae(self, b, reuse=False):
+        t = {}
         if self.use_c:
-            self.s, self.z, self.var = AE3(self.x, self.filters, self.z_num, use_sparse=self.use_sparse,
-                                          num_conv=self.num_conv, repeat=self.repeat)
-            _, self.x_ = jacobian3(self.s)
+            t['s'], t['z'], t['var'] = AE3(b['x'], self.filters, self.z_num, use_sparse=self.use_sparse,
+                                          num_conv=self.num_conv, repeat=self.repeat, reuse=reuse,
+                                          recompute=self.recompute, dtype=self.dtype)
+            _, t['x_'] = jacobian3(t['s'])
         else:
-            self.x_, self.z, self.var = AE3(self.x, self.filters, self.z_num, use_sparse=self.use_sparse,
-                                            num_conv=self.num_conv, repeat=self.repeat)
-        self.x_img = denorm_img3(self.x_) # for debug
-
-        self.x_jaco_, self.x_vort_ = jacobian3(self.x_)
-        self.x_vort_ = denorm_img3(self.x_vort_)
+            t['x_'], t['z'], t['var'] = AE3(b['x'], self.filters, self.z_num, use_sparse=self.use_sparse,
+                                            num_conv=self.num_conv, repeat=self.repeat, reuse=reuse,
+                                            recompute=self.recompute, dtype=self.dtype)
+        t['x_img'] = denorm_img3(t['x_']) # for debug
 
-        show_all_variables()
-
-        if self.optimizer == 'adam':
-            optimizer = tf.train.AdamOptimizer
-            g_optimizer = optimizer(self.g_lr, beta1=self.beta1, beta2=self.beta2)
-        elif self.optimizer == 'gd':
-            optimizer = tf.train.GradientDescentOptimizer
-            g_optimizer = optimizer(self.g_lr)
-        else:
-            raise Exception("[!] Invalid opimizer")
+        t['x_jaco_'], x_vort_ = jacobian3(t['x_'])
+        t['x_vort_'] = denorm_img3(x_vort_)
 
         # losses
-        self.loss_l1 = tf.reduce_mean(tf.abs(self.x_ - self.x))
-        self.loss_j_l1 = tf.reduce_mean(tf.abs(self.x_jaco_ - self.x_jaco))
+        t['loss_l1'] = tf.reduce_mean(tf.abs(t['x_'] - b['x']))
+        t['loss_j_l1'] = tf.reduce_mean(tf.abs(t['x_jaco_'] - b['x_jaco']))
 
-        y = self.y[:,:,-1]
-        self.loss_p = tf.reduce_mean(tf.squared_difference(y, self.z[:,-self.p_num:]))
-        self.loss = self.loss_l1*self.w1 + self.loss_j_l1*self.w2 + self.loss_p*self.w4
+        t['loss_p'] = tf.reduce_mean(tf.squared_difference(b['y'][:,:,-1], t['z'][:,-self.p_num:]))
+        t['loss'] = t['loss_l1']*self.w1 + t['loss_j_l1']*self.w2 + t['loss_p']*self.w4
 
         if self.use_sparse:
             ds = tf.distributions
             rho = ds.Bernoulli(probs=self.sparsity)
-            rho_ = ds.Bernoulli(probs=tf.reduce_mean(self.z[:,:-self.p_num], axis=0))
-            self.loss_kl = tf.reduce_sum(ds.kl_divergence(rho, rho_))
-            self.loss += self.loss_kl*self.w5
+            rho_ = ds.Bernoulli(probs=tf.reduce_mean(t['z'][:,:-self.p_num], axis=0))
+            t['loss_kl'] = tf.reduce_sum(ds.kl_divergence(rho, rho_))
+            t['loss'] += t['loss_kl']*self.w5
+        return t
+
+    def build_model_ae(self):
+        t = self.build_loss_ae(self.batch)
+        vars(self).update(t)
+
+        show_all_variables()
+
+        self.build_optimizers()
+
+        self.build_optims(self.build_loss_ae, t)
+        self.optim = self.optims[0]
 
-        self.optim = g_optimizer.minimize(self.loss, global_step=self.step, var_list=self.var)
         self.epoch = tf.placeholder(tf.float32)
 
         # summary
@@ -436,9 +465,8 @@ class Trainer3(Trainer):
             tf.summary.scalar("loss/loss_p", self.loss_p),
 
             tf.summary.scalar("misc/epoch", self.epoch),
-            tf.summary.scalar('misc/q', self.batch_manager.q.size()),
 
-            tf.summary.histogram("y", y),
+            tf.summary.histogram("y", self.y[:,:,-1]),
             tf.summary.histogram("z", self.z),
 
             tf.summary.scalar("misc/g_lr", self.g_lr),
@@ -449,6 +477,7 @@ class Trainer3(Trainer):
                 tf.summary.scalar("loss/loss_kl", self.loss_kl),
             ]
 
+        summary += self.batch_manager.summary()
         self.summary_op = tf.summary.merge(summary)
 
     def train_ae(self):
@@ -460,12 +489,12 @@ class Trainer3(Trainer):
             f.write(str(sample['z']))
 
         # train
-        for step in trange(self.start_step, self.max_step):
-            self.sess.run(self.optim)
+        for step in trange(self.start_step, self.max_step, self.steps_per_call):
+            first, step = step, self.train_step(self.optims, step)
 
-            if step % self.log_step == 0 or step == self.max_step-1:
+            if self.due(first, step, self.log_step) or step == self.max_step-1:
                 ep = step*self.batch_manager.epochs_per_step
-                loss, summary = self.sess.run([self.loss,self.summary_op],
+                loss, summary = self.run([self.loss,self.summary_op],
                                               feed_dict={self.epoch: ep})
                 assert not np.isnan(loss), 'Model diverged with loss = NaN'
                 print("\n[{}/{}/ep{:.2f}] Loss: {:.6f}".format(step, self.max_step, ep, loss))
@@ -473,29 +502,24 @@ class Trainer3(Trainer):
                 self.summary_writer.add_summary(summary, global_step=step)
                 self.summary_writer.flush()
 
-            if step % self.test_step == 0 or step == self.max_step-1:
+            if self.due(first, step, self.test_step) or step == self.max_step-1:
                 self.autoencode(sample['x'], self.model_dir, idx=step)
 
-            if self.lr_update == 'step':
-                if step % self.lr_update_step == self.lr_update_step - 1:
-                    self.sess.run(self.g_lr_update)
-            else:
-                self.sess.run(self.g_lr_update)
+            self.update_lr(step)
 
         # save last checkpoint..
-        save_path = os.path.join(self.model_dir, 'model.ckpt')
-        self.saver.save(self.sess, save_path, global_step=self.step)
+        self.save_last()
         self.batch_manager.stop_thread()
 
     def build_test_model_ae(self):
         self.x = tf.placeholder(dtype=tf.float32, shape=[self.test_b_num, self.res_z, self.res_y, self.res_x, 3])
         if self.use_c:
             self.s, self.z, self.var = AE3(self.x, self.filters, self.z_num, use_sparse=self.use_sparse,
-                                          num_conv=self.num_conv, repeat=self.repeat, reuse=True)
+                                          num_conv=self.num_conv, repeat=self.repeat, reuse=True, dtype=self.dtype)
             _, self.x_ = jacobian3(self.s)
         else:
             self.x_, self.z, self.var = AE3(self.x, self.filters, self.z_num, use_sparse=self.use_sparse,
-                                              num_conv=self.num_conv, repeat=self.repeat, reuse=True)
+                                              num_conv=self.num_conv, repeat=self.repeat, reuse=True, dtype=self.dtype)
         self.x_img = denorm_img3(self.x_) # for debug
 
     def autoencode(self, x, root_path=None, idx=None):
@@ -30,7 +30,8 @@ def prepare_dirs_and_logger(config):
     logger.addHandler(handler)
 
     # data path
-    config.data_path = os.path.join(config.data_dir, config.dataset)
+    config.data_paths = [os.path.join(config.data_dir, d) for d in config.dataset.split(',')]
+    config.data_path = config.data_paths[0]
     # config.data_path_disc = os.path.join(config.data_dir, config.dataset_disc)
 
     # model path
@@ -39,7 +40,7 @@ def prepare_dirs_and_logger(config):
 
     elif not hasattr(config, 'model_dir'):    
         model_name = "{}/{}_{}_{}".format(
-            config.dataset, get_time(), config.arch, config.tag)
+            config.dataset.replace(',', '+'), get_time(), config.arch, config.tag)
 
         config.model_dir = os.path.join(config.log_dir, model_name)
     
@@ -49,6 +50,15 @@ def prepare_dirs_and_logger(config):
 def get_time():
     return datetime.now().strftime("%m%d_%H%M%S")
 
+def get_rss_mb():
+    # resident set size of this process, only available on linux
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            rss_pages = int(f.read().split()[1])
+        return rss_pages * os.sysconf('SC_PAGE_SIZE') / float(2**20)
+    except (IOError, OSError, AttributeError, ValueError):
+        return 0.0
+
 def save_config(config):
     param_path = os.path.join(config.model_dir, "params.json")
 